@@ -176,3 +176,88 @@ class TacotronSTFT(torch.nn.Module):
         energy = torch.norm(magnitudes, dim=1)
 
         return mel_output, energy
+
+
+class GriffinLim(torch.nn.Module):
+    """Preview vocoder: the mels are mapped back to linear magnitudes through the
+    pseudo-inverse of the mel basis, and the phase is estimated with a small, fixed
+    number of Griffin-Lim iterations, for the whole batch on the device of the mels.
+    """
+
+    def __init__(self, preprocess_config, n_iters=8):
+        super(GriffinLim, self).__init__()
+        stft_config = preprocess_config["preprocessing"]["stft"]
+        mel_config = preprocess_config["preprocessing"]["mel"]
+        self.n_iters = n_iters
+        self.stft_fn = STFT(
+            stft_config["filter_length"],
+            stft_config["hop_length"],
+            stft_config["win_length"],
+        )
+        mel_basis = librosa_mel_fn(
+            preprocess_config["preprocessing"]["audio"]["sampling_rate"],
+            stft_config["filter_length"],
+            mel_config["n_mel_channels"],
+            mel_config["mel_fmin"],
+            mel_config["mel_fmax"],
+        )
+        self.register_buffer(
+            "mel_inverse", torch.from_numpy(np.linalg.pinv(mel_basis)).float()
+        )
+        self.window_sums = {}
+
+    def window_sum(self, n_frames, device):
+        """ Inverse of the window sum square for n_frames, computed once per length """
+        key = (n_frames, str(device))
+        if key not in self.window_sums:
+            window_sum = window_sumsquare(
+                self.stft_fn.window,
+                n_frames,
+                hop_length=self.stft_fn.hop_length,
+                win_length=self.stft_fn.win_length,
+                n_fft=self.stft_fn.filter_length,
+                dtype=np.float32,
+            )
+            # remove modulation effects, where the window sum is not ~0
+            scale = np.ones_like(window_sum)
+            nonzero = window_sum > tiny(window_sum)
+            scale[nonzero] = 1.0 / window_sum[nonzero]
+            scale *= float(self.stft_fn.filter_length) / self.stft_fn.hop_length
+            self.window_sums[key] = torch.from_numpy(scale).to(device)
+        return self.window_sums[key]
+
+    def inverse(self, magnitudes, angles):
+        # Same as STFT.inverse, with the window sum cached on the device
+        signal = F.conv_transpose1d(
+            torch.cat([magnitudes * torch.cos(angles), magnitudes * torch.sin(angles)], dim=1),
+            self.stft_fn.inverse_basis,
+            stride=self.stft_fn.hop_length,
+            padding=0,
+        ).squeeze(1)
+        signal = signal * self.window_sum(magnitudes.size(-1), magnitudes.device)
+        pad = int(self.stft_fn.filter_length / 2)
+        return signal[:, pad:-pad]
+
+    def phase(self, signal):
+        # Same as STFT.transform, without moving the data to the GPU and back
+        pad = int(self.stft_fn.filter_length / 2)
+        signal = F.pad(signal.unsqueeze(1).unsqueeze(1), (pad, pad, 0, 0), mode="reflect")
+        forward_transform = F.conv1d(
+            signal.squeeze(1),
+            self.stft_fn.forward_basis,
+            stride=self.stft_fn.hop_length,
+            padding=0,
+        )
+        cutoff = int((self.stft_fn.filter_length / 2) + 1)
+        return torch.atan2(forward_transform[:, cutoff:, :], forward_transform[:, :cutoff, :])
+
+    def forward(self, mels):
+        magnitudes = torch.clamp(
+            torch.matmul(self.mel_inverse, dynamic_range_decompression(mels)), min=1e-5
+        )
+        angles = 2 * np.pi * torch.rand_like(magnitudes)
+        signal = self.inverse(magnitudes, angles)
+        for _ in range(self.n_iters):
+            signal = self.inverse(magnitudes, self.phase(signal))
+        # Keep the samples in range, they would wrap around in the int16 cast
+        return torch.clamp(signal, min=-1.0, max=1.0)
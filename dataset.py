@@ -3,7 +3,7 @@ import math
 import os
 
 import numpy as np
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 
 from text import text_to_sequence
 from utils.tools import pad_1D, pad_2D
@@ -206,16 +206,56 @@ class TextDataset(Dataset):
                 raw_text.append(r)
             return name, speaker, age, text, raw_text
 
+    def get_lengths(self):
+        """ Phoneme length of every sentence, used to bucket the batches """
+        return [len(text_to_sequence(text, self.cleaners)) for text in self.text]
+
     def collate_fn(self, data):
         ids = [d[0] for d in data]
         speakers = np.array([d[1] for d in data])
+        ages = np.array([d[2] for d in data])
         texts = [d[3] for d in data]
         raw_texts = [d[4] for d in data]
         text_lens = np.array([text.shape[0] for text in texts])
 
         texts = pad_1D(texts)
 
-        return ids, raw_texts, speakers, texts, text_lens, max(text_lens)
+        return ids, raw_texts, speakers, ages, texts, text_lens, max(text_lens)
+
+
+class LengthBucketBatchSampler(Sampler):
+    """ Batch sampler for inference: sentences are sorted by length and grouped
+    so that each padded batch holds at most max_tokens phonemes (and at most
+    max_batch_size sentences), which keeps padding to a minimum """
+
+    def __init__(self, lengths, max_tokens, max_batch_size=None):
+        self.lengths = np.array(lengths)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.batches = self.make_batches()
+
+    def make_batches(self):
+        batches = []
+        batch = []
+        for idx in np.argsort(-self.lengths, kind="stable").tolist():
+            # Sorted by decreasing length, so the first sentence sets the padded length
+            padded_len = self.lengths[batch[0]] if batch else self.lengths[idx]
+            full = (len(batch) + 1) * padded_len > self.max_tokens or (
+                self.max_batch_size is not None and len(batch) >= self.max_batch_size
+            )
+            if batch and full:
+                batches.append(batch)
+                batch = []
+            batch.append(idx)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
 
 
 if __name__ == "__main__":
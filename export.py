@@ -0,0 +1,181 @@
+# Export AgingFastSpeech2 and the HiFi-GAN vocoder to TorchScript or ONNX
+
+import os
+import argparse
+
+import torch
+import torch.nn as nn
+import yaml
+
+from utils.model import get_model, get_vocoder
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+ACOUSTIC_INPUTS = ["speakers", "ages", "texts", "src_lens", "p_control", "e_control", "d_control"]
+ACOUSTIC_OUTPUTS = [
+    "mel",
+    "postnet_mel",
+    "pitch",
+    "energy",
+    "log_duration",
+    "duration",
+    "src_masks",
+    "mel_masks",
+    "src_lens_out",
+    "mel_lens",
+]
+
+
+class AcousticModelWrapper(nn.Module):
+    """ Inference signature of AgingFastSpeech2 with tensors only:
+    the maximum text length comes from the input shape and the controls are scalar tensors """
+
+    def __init__(self, model):
+        super(AcousticModelWrapper, self).__init__()
+        self.model = model
+
+    def forward(self, speakers, ages, texts, src_lens, p_control, e_control, d_control):
+        return self.model(
+            speakers,
+            ages,
+            texts,
+            src_lens,
+            texts.size(1),
+            p_control=p_control,
+            e_control=e_control,
+            d_control=d_control,
+        )
+
+
+def example_inputs(configs):
+    """ Two sentences of different lengths, so that the padding paths are traced """
+    _, model_config, _ = configs
+    text_len = min(64, model_config["max_seq_len"])
+    texts = torch.randint(1, 50, (2, text_len), device=device)
+    src_lens = torch.LongTensor([text_len, text_len // 2]).to(device)
+    texts[1, text_len // 2 :] = 0
+    return (
+        torch.zeros(2, dtype=torch.long, device=device),
+        torch.zeros(2, dtype=torch.long, device=device),
+        texts,
+        src_lens,
+        torch.tensor(1.0, device=device),
+        torch.tensor(1.0, device=device),
+        torch.tensor(1.0, device=device),
+    )
+
+
+def export_torchscript(model, vocoder, configs, output_dir):
+    with torch.no_grad():
+        acoustic_model = torch.jit.trace(
+            AcousticModelWrapper(model), example_inputs(configs), check_trace=False
+        )
+        mels = torch.randn(1, 80, 100, device=device)
+        vocoder = torch.jit.trace(vocoder, mels)
+    acoustic_model.save(os.path.join(output_dir, "acoustic_model.pt"))
+    vocoder.save(os.path.join(output_dir, "vocoder.pt"))
+
+
+def export_onnx(model, vocoder, configs, output_dir, opset_version=11):
+    preprocess_config = configs[0]
+    # Pitch and energy are predicted per phoneme or per mel frame
+    pitch_len = (
+        "text_len"
+        if preprocess_config["preprocessing"]["pitch"]["feature"] == "phoneme_level"
+        else "mel_len"
+    )
+    energy_len = (
+        "text_len"
+        if preprocess_config["preprocessing"]["energy"]["feature"] == "phoneme_level"
+        else "mel_len"
+    )
+    with torch.no_grad():
+        torch.onnx.export(
+            AcousticModelWrapper(model),
+            example_inputs(configs),
+            os.path.join(output_dir, "acoustic_model.onnx"),
+            input_names=ACOUSTIC_INPUTS,
+            output_names=ACOUSTIC_OUTPUTS,
+            dynamic_axes={
+                "speakers": {0: "batch"},
+                "ages": {0: "batch"},
+                "texts": {0: "batch", 1: "text_len"},
+                "src_lens": {0: "batch"},
+                "mel": {0: "batch", 1: "mel_len"},
+                "postnet_mel": {0: "batch", 1: "mel_len"},
+                "pitch": {0: "batch", 1: pitch_len},
+                "energy": {0: "batch", 1: energy_len},
+                "log_duration": {0: "batch", 1: "text_len"},
+                "duration": {0: "batch", 1: "text_len"},
+                "src_masks": {0: "batch", 1: "text_len"},
+                "mel_masks": {0: "batch", 1: "mel_len"},
+                "src_lens_out": {0: "batch"},
+                "mel_lens": {0: "batch"},
+            },
+            opset_version=opset_version,
+        )
+        torch.onnx.export(
+            vocoder,
+            torch.randn(1, 80, 100, device=device),
+            os.path.join(output_dir, "vocoder.onnx"),
+            input_names=["mels"],
+            output_names=["wavs"],
+            dynamic_axes={"mels": {0: "batch", 2: "mel_len"}, "wavs": {0: "batch", 2: "wav_len"}},
+            opset_version=opset_version,
+        )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--restore_step", type=int, required=True)
+    parser.add_argument(
+        "-p",
+        "--preprocess_config",
+        type=str,
+        required=True,
+        help="path to preprocess.yaml",
+    )
+    parser.add_argument(
+        "-m", "--model_config", type=str, required=True, help="path to model.yaml"
+    )
+    parser.add_argument(
+        "-t", "--train_config", type=str, required=True, help="path to train.yaml"
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=["torchscript", "onnx"],
+        default="torchscript",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default=None,
+        help="where to save the exported models, by default <ckpt_path>/export_<restore_step>",
+    )
+    args = parser.parse_args()
+
+    # Read Config
+    preprocess_config = yaml.load(
+        open(args.preprocess_config, "r"), Loader=yaml.FullLoader
+    )
+    model_config = yaml.load(open(args.model_config, "r"), Loader=yaml.FullLoader)
+    train_config = yaml.load(open(args.train_config, "r"), Loader=yaml.FullLoader)
+    configs = (preprocess_config, model_config, train_config)
+
+    output_dir = args.output_dir
+    if output_dir is None:
+        output_dir = os.path.join(
+            train_config["path"]["ckpt_path"], "export_{}".format(args.restore_step)
+        )
+    os.makedirs(output_dir, exist_ok=True)
+
+    model = get_model(args, configs, device, train=False)
+    vocoder = get_vocoder(model_config, device)
+
+    if args.format == "torchscript":
+        export_torchscript(model, vocoder, configs, output_dir)
+    else:
+        export_onnx(model, vocoder, configs, output_dir)
+    print("Exported models saved in {}".format(output_dir))
@@ -1,4 +1,5 @@
 from .aging_fastspeech2 import AgingFastSpeech2
 from .aging_fastspeech2_bn import AgingFastSpeech2bn
 from .loss import FastSpeech2Loss
-from .optimizer import ScheduledOptim
\ No newline at end of file
+from .optimizer import ScheduledOptim
+from .conditioning import AgeConditioningTable, ConditioningCache
\ No newline at end of file
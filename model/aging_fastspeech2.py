@@ -42,21 +42,60 @@ class AgingFastSpeech2(nn.Module):
             self.speaker_emb = nn.Embedding.from_pretrained(
                                             speaker_emb_dict, freeze=True)
             
+        self.age_emb = None
         if model_config["multi_age"]: 
             with open(os.path.join(preprocess_config["path"]["preprocessed_path"], "ages.json"), "r") as f:
                 n_age = len(json.load(f))
             self.age_emb = nn.Embedding(n_age, model_config["age_embedding"]["embedding_hidden"])
-            
+
+    def get_age_embedding(self, ages):
+        """ Age vector added to the encoder output. ages are either age ids or
+        vectors in the age embedding space (e.g. interpolated between age groups) """
+        if ages.is_floating_point():
+            return ages
+        return self.age_emb(ages)
+
+    def get_conditioning(self, speakers, ages, age_vectors=None):
+        """ Sum of the age and speaker vectors added to every position of the encoder output.
+        age_vectors (batch x encoder_hidden), if given, replace the age embedding of ages """
+        conditioning = None
         
-    def forward(
+        # The age embedding is added to the input tensor
+        if age_vectors is not None:
+            conditioning = age_vectors
+        elif self.age_emb is not None:
+            conditioning = self.get_age_embedding(ages)
+        
+        # The speaker embedding is also added to the output
+        if self.speaker_emb is not None:
+            speaker_embedding = self.speaker_emb(speakers)
+            conditioning = (
+                speaker_embedding if conditioning is None else conditioning + speaker_embedding
+            )
+        return conditioning
+
+    def add_conditioning(self, output, conditioning):
+        """ Add the conditioning vectors to every position of the encoder output,
+        in place when no gradient is needed """
+        if conditioning is None:
+            return output
+        if torch.is_grad_enabled():
+            return output + conditioning.unsqueeze(1)
+        return output.add_(conditioning.unsqueeze(1))
+
+    def encode(self, texts, src_lens, max_src_len):
+        src_masks = get_mask_from_lengths(src_lens, max_src_len)
+        
+        # The encoder processes the input text and it is added to the encoder output
+        output = self.encoder(texts, src_masks)
+        return output, src_masks
+
+    def decode(
         self,
-        speakers,
-        ages,
-        texts,
+        output,
+        src_masks,
         src_lens,
-        max_src_len,
-        mels=None,
-        mel_lens=None,
+        mel_masks=None,
         max_mel_len=None,
         p_targets=None,
         e_targets=None,
@@ -65,26 +104,6 @@ class AgingFastSpeech2(nn.Module):
         e_control=1.0,
         d_control=1.0,
     ):
-        src_masks = get_mask_from_lengths(src_lens, max_src_len)
-        mel_masks = (
-            get_mask_from_lengths(mel_lens, max_mel_len)
-            if mel_lens is not None
-            else None
-        )
-            
-        # The encoder processes the input text and it is added to the encoder output
-        output = self.encoder(texts, src_masks)
-        
-        # The age embedding is added to the input tensor
-        if self.age_emb is not None:
-            output = output + self.age_emb(ages).unsqueeze(1).expand(-1, max_src_len, -1)
-        
-        # The speaker embedding is also added to the output
-        if self.speaker_emb is not None:
-            output = output + self.speaker_emb(speakers).unsqueeze(1).expand(
-                -1, max_src_len, -1
-            )           
-
         (
             output,
             p_predictions,
@@ -122,4 +141,85 @@ class AgingFastSpeech2(nn.Module):
             mel_masks,
             src_lens,
             mel_lens,
-        )
\ No newline at end of file
+        )
+        
+    def forward(
+        self,
+        speakers,
+        ages,
+        texts,
+        src_lens,
+        max_src_len,
+        mels=None,
+        mel_lens=None,
+        max_mel_len=None,
+        p_targets=None,
+        e_targets=None,
+        d_targets=None,
+        p_control=1.0,
+        e_control=1.0,
+        d_control=1.0,
+        age_vectors=None,
+        conditioning=None,
+    ):
+        """ conditioning, the summed speaker and age vectors (e.g. from a
+        ConditioningCache), replaces the speaker and age embeddings if given """
+        mel_masks = (
+            get_mask_from_lengths(mel_lens, max_mel_len)
+            if mel_lens is not None
+            else None
+        )
+            
+        output, src_masks = self.encode(texts, src_lens, max_src_len)
+
+        if conditioning is None:
+            conditioning = self.get_conditioning(speakers, ages, age_vectors)
+        output = self.add_conditioning(output, conditioning)
+
+        return self.decode(
+            output,
+            src_masks,
+            src_lens,
+            mel_masks,
+            max_mel_len,
+            p_targets,
+            e_targets,
+            d_targets,
+            p_control,
+            e_control,
+            d_control,
+        )
+
+    def forward_age_sweep(
+        self,
+        speakers,
+        ages,
+        texts,
+        src_lens,
+        max_src_len,
+        p_control=1.0,
+        e_control=1.0,
+        d_control=1.0,
+    ):
+        """ Synthesize every sentence of the batch with every age in ages (age ids,
+        or age embeddings), running the encoder only once per sentence.
+        The outputs are sentence-major: row i * len(ages) + j is sentence i with age j """
+        batch_size, n_ages = texts.size(0), ages.size(0)
+        output, src_masks = self.encode(texts, src_lens, max_src_len)
+
+        output = output.repeat_interleave(n_ages, dim=0)
+        src_masks = src_masks.repeat_interleave(n_ages, dim=0)
+        src_lens = src_lens.repeat_interleave(n_ages, dim=0)
+        speakers = speakers.repeat_interleave(n_ages, dim=0)
+        ages = ages.repeat(batch_size, *([1] * (ages.dim() - 1)))
+
+        output = self.add_conditioning(output, self.get_conditioning(speakers, ages))
+
+        return self.decode(
+            output,
+            src_masks,
+            src_lens,
+            p_control=p_control,
+            e_control=e_control,
+            d_control=d_control,
+        )
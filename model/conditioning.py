@@ -0,0 +1,95 @@
+from collections import OrderedDict
+
+import torch
+
+
+class AgeConditioningTable:
+    """ Precomputed age vectors for continuous age control.
+
+    The age groups are placed on an axis in the order of their ids in ages.json
+    (e.g. child = 0, adult = 1, senior = 2). A continuous age value v between two
+    groups interpolates their age embeddings, and the age vector the model adds
+    to the encoder output (including age_proj for the bottleneck model) is
+    evaluated once for a grid of resolution values per group interval.
+    Requests then only do a table lookup. Mixing weights over the age groups
+    are evaluated once per distinct set of weights and memoized.
+    """
+
+    def __init__(self, model, resolution=20):
+        self.model = model
+        self.resolution = resolution
+        self.mixes = {}
+        self.build()
+
+    def build(self):
+        weight = self.model.age_emb.weight
+        self.n_age = weight.size(0)
+        n_steps = max(self.n_age - 1, 0) * self.resolution + 1
+
+        with torch.no_grad():
+            grid = torch.linspace(0, self.n_age - 1, n_steps, device=weight.device)
+            low = torch.clamp(grid.floor().long(), max=max(self.n_age - 2, 0))
+            high = torch.clamp(low + 1, max=self.n_age - 1)
+            frac = (grid - low.float()).unsqueeze(1)
+            embeddings = weight[low] * (1 - frac) + weight[high] * frac
+            self.table = self.model.get_age_embedding(embeddings)
+        self.mixes = {}
+
+    def lookup(self, values):
+        """ Age vectors for continuous age values (a float or a 1D tensor) """
+        values = torch.as_tensor(values, dtype=torch.float, device=self.table.device)
+        idx = torch.round(torch.clamp(values, 0, self.n_age - 1) * self.resolution).long()
+        return self.table[idx]
+
+    def mix(self, weights):
+        """ Age vector for mixing weights over the age groups (a sequence of n_age floats) """
+        total = float(sum(weights))
+        key = tuple(round(float(w) / total, 3) for w in weights)
+        if key not in self.mixes:
+            weight = self.model.age_emb.weight
+            with torch.no_grad():
+                mix = torch.tensor(key, dtype=weight.dtype, device=weight.device)
+                self.mixes[key] = self.model.get_age_embedding(
+                    torch.matmul(mix, weight).unsqueeze(0)
+                )[0]
+        return self.mixes[key]
+
+
+class ConditioningCache:
+    """ Inference cache of the summed speaker and age vectors, keyed by (speaker, age) ids.
+
+    The vectors are recomputed whenever the speaker or age weights of the
+    model change (e.g. when a checkpoint is loaded or an optimizer steps).
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.cache = {}
+        self.version = None
+
+    def weights_version(self):
+        return tuple(
+            (param.data_ptr(), param._version)
+            for name, param in self.model.named_parameters()
+            if name.split(".")[0] in ["speaker_emb", "age_emb", "age_proj"]
+        )
+
+    def get(self, speakers, ages):
+        """ Conditioning vectors (batch x encoder_hidden) for speaker and age id tensors """
+        version = self.weights_version()
+        if version != self.version:
+            self.cache = {}
+            self.version = version
+
+        keys = list(zip(speakers.tolist(), ages.tolist()))
+        missing = list(OrderedDict.fromkeys(key for key in keys if key not in self.cache))
+        if missing:
+            with torch.no_grad():
+                conditioning = self.model.get_conditioning(
+                    torch.LongTensor([key[0] for key in missing]).to(speakers.device),
+                    torch.LongTensor([key[1] for key in missing]).to(ages.device),
+                )
+            for key, vector in zip(missing, conditioning):
+                self.cache[key] = vector
+
+        return torch.stack([self.cache[key] for key in keys])
@@ -10,9 +10,14 @@ import torch.nn as nn
 import numpy as np
 import torch.nn.functional as F
 
-from utils.tools import get_mask_from_lengths, pad
+from utils.tools import get_positions
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+def bucketize(values, boundaries):
+    if torch.onnx.is_in_onnx_export():
+        # bucketize has no ONNX equivalent
+        return torch.sum(values.unsqueeze(-1) > boundaries, dim=-1)
+    return torch.bucketize(values, boundaries)
 
 
 class VarianceAdaptor(nn.Module):
@@ -82,16 +87,16 @@ class VarianceAdaptor(nn.Module):
     def get_pitch_embedding(self, x, target, mask, control):
         prediction = self.pitch_predictor(x, mask)
         if target is not None:
-            embedding = self.pitch_embedding(torch.bucketize(target, self.pitch_bins))
+            embedding = self.pitch_embedding(bucketize(target, self.pitch_bins))
 
         else:
             prediction = prediction * control
             embedding = self.pitch_embedding(
-                torch.bucketize(prediction, self.pitch_bins)
+                bucketize(prediction, self.pitch_bins)
             )
             
         # Validate the shape of embedding against x
-        if embedding.shape[1] != x.shape[1]:
+        if not torch.jit.is_tracing() and embedding.shape[1] != x.shape[1]:
             print(f"Dimension mismatch detected. x.shape[1]: {x.shape[1]}, embedding.shape[1]: {embedding.shape[1]}")
         
         return prediction, embedding
@@ -99,11 +104,11 @@ class VarianceAdaptor(nn.Module):
     def get_energy_embedding(self, x, target, mask, control):
         prediction = self.energy_predictor(x, mask)
         if target is not None:
-            embedding = self.energy_embedding(torch.bucketize(target, self.energy_bins))
+            embedding = self.energy_embedding(bucketize(target, self.energy_bins))
         else:
             prediction = prediction * control
             embedding = self.energy_embedding(
-                torch.bucketize(prediction, self.energy_bins)
+                bucketize(prediction, self.energy_bins)
             )
         return prediction, embedding        
 
@@ -135,15 +140,18 @@ class VarianceAdaptor(nn.Module):
             x = x + energy_embedding
 
         if duration_target is not None:
-            x, mel_len = self.length_regulator(x, duration_target, max_len)
+            x, mel_len, regulated_mask = self.length_regulator(x, duration_target, max_len)
             duration_rounded = duration_target
         else:
             duration_rounded = torch.clamp(
                 (torch.round(torch.exp(log_duration_prediction) - 1) * d_control),
                 min=0,
             )
-            x, mel_len = self.length_regulator(x, duration_rounded, max_len)
-            mel_mask = get_mask_from_lengths(mel_len)
+            x, mel_len, regulated_mask = self.length_regulator(x, duration_rounded, max_len)
+            mel_mask = None
+        if mel_mask is None:
+            # The length regulator already built the mask of the expanded frames
+            mel_mask = regulated_mask
 
         if self.pitch_feature_level == "frame_level":
             pitch_prediction, pitch_embedding = self.get_pitch_embedding(
@@ -174,33 +182,31 @@ class LengthRegulator(nn.Module):
         super(LengthRegulator, self).__init__()
 
     def LR(self, x, duration, max_len):
-        output = list()
-        mel_len = list()
-        for batch, expand_target in zip(x, duration):
-            expanded = self.expand(batch, expand_target)
-            output.append(expanded)
-            mel_len.append(expanded.shape[0])
-
-        if max_len is not None:
-            output = pad(output, max_len)
+        # Expand the whole batch at once: the phoneme used for frame t is the
+        # first one whose cumulative duration is larger than t
+        duration = torch.clamp(duration, min=0).long()
+        mel_len = torch.sum(duration, dim=1)
+        if max_len is None:
+            max_len = torch.max(mel_len)
+
+        cum_duration = torch.cumsum(duration, dim=1)
+        frames = get_positions(max_len, x.device).unsqueeze(0).expand(x.size(0), -1)
+        if torch.onnx.is_in_onnx_export():
+            # searchsorted has no ONNX equivalent
+            idx = torch.sum(cum_duration.unsqueeze(1) <= frames.unsqueeze(2), dim=2)
         else:
-            output = pad(output)
-
-        return output, torch.LongTensor(mel_len).to(device)
+            idx = torch.searchsorted(cum_duration, frames.contiguous(), right=True)
+        idx = torch.clamp(idx, max=x.size(1) - 1)
 
-    def expand(self, batch, predicted):
-        out = list()
+        output = torch.gather(x, 1, idx.unsqueeze(-1).expand(-1, -1, x.size(2)))
+        mask = frames >= mel_len.unsqueeze(1)
+        output = output.masked_fill(mask.unsqueeze(-1), 0.0)
 
-        for i, vec in enumerate(batch):
-            expand_size = predicted[i].item()
-            out.append(vec.expand(max(int(expand_size), 0), -1))
-        out = torch.cat(out, 0)
-
-        return out
+        return output, mel_len, mask
 
     def forward(self, x, duration, max_len):
-        output, mel_len = self.LR(x, duration, max_len)
-        return output, mel_len
+        output, mel_len, mask = self.LR(x, duration, max_len)
+        return output, mel_len, mask
 
 
 class VariancePredictor(nn.Module):
@@ -0,0 +1,126 @@
+# Build the int8 model for CPU inference and compare it with the float model on val.txt
+
+import os
+import io
+import time
+import argparse
+
+import torch
+import yaml
+from torch.utils.data import DataLoader
+
+from utils.model import get_model, get_quantized_model
+from utils.tools import to_device
+from model import FastSpeech2Loss
+from dataset import Dataset
+
+
+device = torch.device("cpu")
+
+
+def model_size(model):
+    """ Size in MB of the serialized state dict """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 1e6
+
+
+def compare(model, quantized_model, configs):
+    preprocess_config, model_config, train_config = configs
+
+    # Get dataset
+    dataset = Dataset(
+        "val.txt", preprocess_config, train_config, sort=False, drop_last=False
+    )
+    batch_size = train_config["optimizer"]["batch_size"]
+    loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        collate_fn=dataset.collate_fn,
+    )
+
+    # Get loss function
+    Loss = FastSpeech2Loss(preprocess_config, model_config).to(device)
+
+    models = {"float": model, "int8": quantized_model}
+    loss_sums = {name: [0 for _ in range(6)] for name in models}
+    times = {name: 0.0 for name in models}
+    mel_diff_sum = 0.0
+    n_frames = 0
+    for batchs in loader:
+        for batch in batchs:
+            batch = to_device(batch, device)
+            with torch.no_grad():
+                outputs = {}
+                for name, m in models.items():
+                    # Teacher-forced forward, for the losses against the targets
+                    outputs[name] = m(*(batch[2:]))
+                    losses = Loss(batch, outputs[name])
+                    for i in range(len(losses)):
+                        loss_sums[name][i] += losses[i].item() * len(batch[0])
+
+                    # Inference forward, for the speed
+                    start = time.perf_counter()
+                    m(*(batch[2:7]))
+                    times[name] += time.perf_counter() - start
+
+                mel_masks = ~outputs["float"][7]
+                mel_diff = torch.abs(outputs["float"][1] - outputs["int8"][1])
+                mel_diff_sum += mel_diff.masked_select(mel_masks.unsqueeze(-1)).sum().item()
+                n_frames += mel_masks.sum().item() * mel_diff.size(2)
+
+    lines = []
+    for name, m in models.items():
+        loss_means = [loss_sum / len(dataset) for loss_sum in loss_sums[name]]
+        lines.append(
+            "{}: {:.1f} MB, {:.2f} s, Total Loss: {:.4f}, Mel Loss: {:.4f}, Mel PostNet Loss: {:.4f}, Pitch Loss: {:.4f}, Energy Loss: {:.4f}, Duration Loss: {:.4f}".format(
+                *([name, model_size(m), times[name]] + loss_means)
+            )
+        )
+    lines.append(
+        "Speed-up: {:.2f}x, Mel PostNet L1 between float and int8: {:.4f}".format(
+            times["float"] / times["int8"], mel_diff_sum / n_frames
+        )
+    )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--restore_step", type=int, required=True)
+    parser.add_argument(
+        "-p",
+        "--preprocess_config",
+        type=str,
+        required=True,
+        help="path to preprocess.yaml",
+    )
+    parser.add_argument(
+        "-m", "--model_config", type=str, required=True, help="path to model.yaml"
+    )
+    parser.add_argument(
+        "-t", "--train_config", type=str, required=True, help="path to train.yaml"
+    )
+    args = parser.parse_args()
+
+    # Read Config
+    preprocess_config = yaml.load(
+        open(args.preprocess_config, "r"), Loader=yaml.FullLoader
+    )
+    model_config = yaml.load(open(args.model_config, "r"), Loader=yaml.FullLoader)
+    train_config = yaml.load(open(args.train_config, "r"), Loader=yaml.FullLoader)
+    configs = (preprocess_config, model_config, train_config)
+
+    # Get models
+    model = get_model(args, configs, device, train=False)
+    quantized_model = get_quantized_model(args, configs)
+
+    message = compare(model, quantized_model, configs)
+    print(message)
+    report_path = os.path.join(
+        train_config["path"]["result_path"], "quantization_{}.txt".format(args.restore_step)
+    )
+    with open(report_path, "w") as f:
+        f.write(message + "\n")
@@ -0,0 +1,379 @@
+# Synthesis server keeping AgingFastSpeech2 and the vocoder resident in memory
+
+import io
+import os
+import json
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+import torch
+import yaml
+import numpy as np
+from scipy.io import wavfile
+
+from utils.model import VOCODERS, get_model, get_vocoder, get_vocoder_id
+from utils.cache import UtteranceCache
+from model import ConditioningCache
+from utils.scheduler import MicroBatchScheduler
+from utils.tools import pad_1D
+from synthesize import preprocess_english, synthesize, synthesize_stream
+from text.g2p import get_g2p_cache
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+class SynthesisService:
+    """ Loads the acoustic model and the vocoder once and answers synthesis requests """
+
+    def __init__(
+        self,
+        args,
+        configs,
+        max_batch_size=8,
+        batch_window=0.01,
+        cache_size=1000,
+        cache_dir=None,
+        cache_ttl=None,
+        vocoder=None,
+    ):
+        self.configs = configs
+        self.restore_step = args.restore_step
+        preprocess_config, model_config, train_config = configs
+
+        self.model = get_model(args, configs, device, train=False)
+        self.default_vocoder = vocoder if vocoder is not None else model_config["vocoder"]["model"]
+        self.vocoders = {}
+        self.vocoders_lock = threading.Lock()
+        self.get_vocoder(self.default_vocoder)
+        self.conditioning_cache = ConditioningCache(self.model)
+        # Serializes the forward passes of the batch scheduler and of the streaming requests
+        self.inference_lock = threading.Lock()
+        self.utterance_cache = UtteranceCache(
+            os.path.join(train_config["path"]["ckpt_path"], str(args.restore_step)),
+            maxsize=cache_size,
+            path=cache_dir,
+            ttl=cache_ttl,
+        )
+
+        with open(os.path.join(preprocess_config["path"]["preprocessed_path"], "speakers.json")) as f:
+            self.speaker_id_map = json.load(f)
+        with open(os.path.join(preprocess_config["path"]["preprocessed_path"], "ages.json")) as f:
+            self.ages_id_map = json.load(f)
+
+        self.sampling_rate = preprocess_config["preprocessing"]["audio"]["sampling_rate"]
+        self.scheduler = MicroBatchScheduler(
+            self.synthesize_batch, max_batch_size=max_batch_size, max_wait=batch_window
+        )
+
+    def get_vocoder(self, name):
+        """ Vocoders are loaded the first time they are requested """
+        with self.vocoders_lock:
+            if name not in self.vocoders:
+                preprocess_config, model_config, _ = self.configs
+                self.vocoders[name] = get_vocoder(
+                    model_config, device, name=name, preprocess_config=preprocess_config
+                )
+            return self.vocoders[name]
+
+    def parse_request(self, request):
+        """ Validate a request and map it to the model inputs """
+        if not isinstance(request, dict):
+            raise ValueError("The request body must be a JSON object.")
+        text = request.get("text")
+        if not text:
+            raise ValueError("Missing 'text' field.")
+
+        speaker = request.get("speaker_id")
+        if speaker not in self.speaker_id_map:
+            raise ValueError("Invalid speaker ID '{}'.".format(speaker))
+
+        age = str(request.get("age", "adult")).lower()
+        if age not in self.ages_id_map:
+            raise ValueError(
+                "Invalid age group. Please choose from: {}.".format(list(self.ages_id_map.keys()))
+            )
+
+        control_values = (
+            float(request.get("pitch_control", 1.0)),
+            float(request.get("energy_control", 1.0)),
+            float(request.get("duration_control", 1.0)),
+        )
+
+        vocoder = request.get("vocoder", self.default_vocoder)
+        if vocoder not in VOCODERS:
+            raise ValueError(
+                "Invalid vocoder. Please choose from: {}.".format(list(VOCODERS.keys()))
+            )
+        return text, self.speaker_id_map[speaker], self.ages_id_map[age], control_values, vocoder
+
+    def synthesize_batch(self, requests):
+        """ Run requests sharing the same control values and vocoder as one padded batch """
+        ids = raw_texts = [request[0][:100] for request in requests]
+        speakers = np.array([request[1] for request in requests])
+        ages = np.array([request[2] for request in requests])
+        texts = [request[3] for request in requests]
+        text_lens = np.array([len(sequence) for sequence in texts])
+        batch = (ids, raw_texts, speakers, ages, pad_1D(texts), text_lens, max(text_lens))
+        control_values, vocoder = requests[0][4], requests[0][5]
+        vocoder = self.get_vocoder(vocoder)
+        with self.inference_lock:
+            return synthesize(
+                self.model,
+                self.restore_step,
+                self.configs,
+                vocoder,
+                [batch],
+                control_values,
+                save_outputs=False,
+                conditioning_cache=self.conditioning_cache,
+            )
+
+    def synthesize_stream(self, request):
+        text, speaker_id, age, control_values, vocoder = self.parse_request(request)
+        return synthesize_stream(
+            self.model,
+            self.configs,
+            self.get_vocoder(vocoder),
+            text,
+            speaker_id,
+            age,
+            control_values,
+            lock=self.inference_lock,
+        )
+
+    def synthesize(self, request):
+        text, speaker_id, age, control_values, vocoder = self.parse_request(request)
+        sequence = preprocess_english(text, self.configs[0])
+
+        key = self.utterance_cache.key(
+            sequence,
+            speaker_id,
+            age,
+            control_values,
+            vocoder=get_vocoder_id(self.configs[1], vocoder),
+        )
+        wav = self.utterance_cache.get(key)
+        if wav is None:
+            wav = self.scheduler.submit(
+                (text, speaker_id, age, sequence, control_values, vocoder),
+                len(sequence),
+                key=(control_values, vocoder),
+            )
+            self.utterance_cache.put(key, wav)
+        return wav
+
+
+class SynthesisRequestHandler(BaseHTTPRequestHandler):
+    """ POST /synthesize with a JSON body returns a wav file, POST /synthesize_stream returns
+    raw 16-bit PCM chunks as soon as they are ready, GET /health returns the server status """
+
+    service = None
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        # Unix sockets have no client address
+        if isinstance(self.client_address, tuple) and self.client_address:
+            return str(self.client_address[0])
+        return "unix"
+
+    def send_json(self, code, content):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_wav(self, wav):
+        buffer = io.BytesIO()
+        wavfile.write(buffer, self.service.sampling_rate, wav)
+        body = buffer.getvalue()
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/wav")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, wavs):
+        self.send_response(200)
+        self.send_header(
+            "Content-Type", "audio/L16; rate={}; channels=1".format(self.service.sampling_rate)
+        )
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for wav in wavs:
+            body = wav.astype("<i2").tobytes()
+            if len(body) == 0:
+                continue
+            self.wfile.write("{:X}\r\n".format(len(body)).encode("ascii") + body + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def discard_body(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length).decode("utf-8"))
+
+    def do_GET(self):
+        if self.path != "/health":
+            self.send_json(404, {"error": "Unknown endpoint '{}'.".format(self.path)})
+            return
+        self.send_json(
+            200,
+            {
+                "status": "ok",
+                "restore_step": self.service.restore_step,
+                "requests": self.service.scheduler.n_requests,
+                "batches": self.service.scheduler.n_batches,
+                "g2p_cache": get_g2p_cache(
+                    self.service.configs[0]["path"].get("g2p_cache_path")
+                ).stats(),
+                "utterance_cache": self.service.utterance_cache.stats(),
+            },
+        )
+
+    def do_POST(self):
+        if self.path not in ["/synthesize", "/synthesize_stream"]:
+            # Read the body, so that the connection can be kept alive
+            self.discard_body()
+            self.send_json(404, {"error": "Unknown endpoint '{}'.".format(self.path)})
+            return
+        try:
+            request = self.read_json()
+            if self.path == "/synthesize_stream":
+                wavs = self.service.synthesize_stream(request)
+            else:
+                wav = self.service.synthesize(request)
+        except (ValueError, KeyError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            self.log_error("Synthesis failed: %r", e)
+            self.send_json(500, {"error": "Synthesis failed."})
+            return
+        if self.path == "/synthesize_stream":
+            try:
+                self.send_stream(wavs)
+            except Exception as e:
+                # The status has already been sent, the response can only be cut short
+                self.log_error("Streaming failed: %r", e)
+                self.close_connection = True
+        else:
+            self.send_wav(wav)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(service, host="127.0.0.1", port=8000, socket_path=None):
+    SynthesisRequestHandler.service = service
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, SynthesisRequestHandler)
+        print("Serving on unix socket {}".format(socket_path))
+    else:
+        server = ThreadingHTTPServer((host, port), SynthesisRequestHandler)
+        print("Serving on http://{}:{}".format(host, port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--restore_step", type=int, required=True)
+    parser.add_argument(
+        "-p",
+        "--preprocess_config",
+        type=str,
+        required=True,
+        help="path to preprocess.yaml",
+    )
+    parser.add_argument(
+        "-m", "--model_config", type=str, required=True, help="path to model.yaml"
+    )
+    parser.add_argument(
+        "-t", "--train_config", type=str, required=True, help="path to train.yaml"
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--socket",
+        type=str,
+        default=None,
+        help="path to a unix socket to listen on instead of host:port",
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=8,
+        help="maximum number of concurrent requests synthesized in one forward pass",
+    )
+    parser.add_argument(
+        "--batch_window",
+        type=float,
+        default=10,
+        help="time in milliseconds to wait for concurrent requests before running a batch",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        default=1000,
+        help="number of synthesized utterances kept in memory for repeated requests, 0 to disable",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="directory where the synthesized utterances are also cached on disk",
+    )
+    parser.add_argument(
+        "--cache_ttl",
+        type=float,
+        default=None,
+        help="time in seconds after which a cached utterance is synthesized again",
+    )
+    parser.add_argument(
+        "--vocoder",
+        type=str,
+        default=None,
+        help="default vocoder of the requests (e.g. HiFi-GAN or Griffin-Lim), by default the one of model.yaml",
+    )
+    args = parser.parse_args()
+
+    # Read Config
+    preprocess_config = yaml.load(
+        open(args.preprocess_config, "r"), Loader=yaml.FullLoader
+    )
+    model_config = yaml.load(open(args.model_config, "r"), Loader=yaml.FullLoader)
+    train_config = yaml.load(open(args.train_config, "r"), Loader=yaml.FullLoader)
+    configs = (preprocess_config, model_config, train_config)
+
+    service = SynthesisService(
+        args,
+        configs,
+        max_batch_size=args.max_batch_size,
+        batch_window=args.batch_window / 1000,
+        cache_size=args.cache_size,
+        cache_dir=args.cache_dir,
+        cache_ttl=args.cache_ttl,
+        vocoder=args.vocoder,
+    )
+    serve(service, args.host, args.port, args.socket)
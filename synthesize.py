@@ -1,7 +1,9 @@
 # Doing inference with FastSpeech2 with age control
 
+import os
 import re
 import argparse
+import threading
 from string import punctuation
 
 import torch
@@ -10,31 +12,30 @@ import json
 import numpy as np
 from torch.utils.data import DataLoader
 #from g2p_en import G2p
-import eng_to_ipa as ipa
 
-from utils.model import get_model, get_vocoder
-from utils.tools import to_device, synth_samples
-from dataset import TextDataset
+from utils.model import (
+    BucketedModel,
+    get_model,
+    get_quantized_model,
+    get_vocoder,
+    get_exported_model,
+    get_vocoder_id,
+    StreamingVocoder,
+)
+from utils.cache import UtteranceCache, VocoderCache
+from model import AgeConditioningTable, ConditioningCache
+from utils.tools import to_device, synth_samples, pad_1D, MelPlotter, WavWriter
+from dataset import TextDataset, LengthBucketBatchSampler
 from text import text_to_sequence, text_to_sequence_ipa
+from text.lexicon import get_lexicon
+from text.g2p import get_g2p_cache
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-def read_lexicon(lex_path):
-    lexicon = {}
-    with open(lex_path) as f:
-        for line in f:
-            temp = re.split(r"\s+", line.strip("\n"))
-            word = temp[0]
-            phones = temp[1:]
-            if word.lower() not in lexicon:
-                lexicon[word.lower()] = phones
-    return lexicon
-
-
 def preprocess_english(text, preprocess_config):
     text = text.rstrip(punctuation)
-    lexicon = read_lexicon(preprocess_config["path"]["lexicon_path"])
-    #g2p = G2p()
+    lexicon = get_lexicon(preprocess_config["path"]["lexicon_path"])
+    g2p = get_g2p_cache(preprocess_config["path"].get("g2p_cache_path"))
     
     phones = []
     ipa_seq = None
@@ -45,16 +46,11 @@ def preprocess_english(text, preprocess_config):
             phones += lexicon[w.lower()]
         if w.lower() != ' ' and w.lower() not in lexicon:
             #print(f'w.lower() not in lexicon: {w.lower() not in lexicon}')
-            ipa_list = list(ipa.convert(w))
-            #print(ipa_list)
-            ipa_seq = ''
-            for s in ipa_list:
-                #print('s is'), s == "'")
-                if s != "'":
-                    ipa_seq += f'{s} '
+            ipa_phones = g2p.convert(w)
+            ipa_seq = " ".join(ipa_phones)
             print(f'IPA sequence: {ipa_seq}')
             #phones += list(filter(lambda p: p != " ", g2p(w)))
-            phones += ipa_seq.split()
+            phones += ipa_phones
     phones = "{" + "}{".join(phones) + "}"
     phones = re.sub(r"\{[^\w\s]?\}", "{sp}", phones)
     phones = phones.replace("}{", " ")
@@ -81,35 +77,228 @@ def preprocess_english(text, preprocess_config):
 
     return np.array(sequence)
 
-def map_age_to_idx(age):
+def map_age_to_idx(age, preprocess_config):
     with open(f'{preprocess_config["path"]["preprocessed_path"]}/ages.json') as f:
             ages_id_map = json.load(f)
     age = ages_id_map[age]
     return age
 
-def synthesize(model, step, configs, vocoder, batchs, control_values):
+def prepare_single_batch(text, speaker_id, age, preprocess_config):
+    """ Build the inference batch tuple for one sentence """
+    ids = raw_texts = [text[:100]]
+    speakers = np.array([speaker_id])
+    if preprocess_config["preprocessing"]["text"]["language"] == "en":
+        texts = np.array([preprocess_english(text, preprocess_config)])
+    text_lens = np.array([len(texts[0])])
+    ages = np.array([age])
+    return (ids, raw_texts, speakers, ages, texts, text_lens, max(text_lens))
+
+def split_text(text, delimiters=",;:.?!"):
+    """ Split text after the given punctuation into chunks that can be synthesized independently """
+    chunks = re.split(r"(?<=[{}])\s+".format(re.escape(delimiters)), text.strip())
+    return [chunk for chunk in chunks if chunk.rstrip(punctuation).strip()]
+
+def split_sequence(sequence):
+    """ Split a phoneme sequence after each {sp} pause, keeping the pause at the end of its chunk """
+    sp = text_to_sequence("{sp}", [])[0]
+    ends = [i + 1 for i, symbol in enumerate(sequence) if symbol == sp]
+    chunks = np.split(sequence, ends)
+    return [chunk for chunk in chunks if len(chunk) > 0]
+
+def synthesize_stream(model, configs, vocoder, text, speaker_id, age, control_values, lock=None):
+    """ Synthesize text pause by pause and return a generator of int16 wav blocks, yielded as
+    soon as they are vocoded. The text frontend runs before returning, so that its errors are
+    raised here. If a lock is given, it is held during each forward pass of the model and vocoder """
     preprocess_config, model_config, train_config = configs
     pitch_control, energy_control, duration_control = control_values
+    lock = threading.Lock() if lock is None else lock
+
+    # The whole text goes through the frontend, as for /synthesize, so that the clause
+    # pauses are kept, and the phoneme sequence is cut at the pauses
+    batch = prepare_single_batch(text, speaker_id, age, preprocess_config)
+    batchs = [
+        (
+            batch[0],
+            batch[1],
+            batch[2],
+            batch[3],
+            np.array([chunk]),
+            np.array([len(chunk)]),
+            len(chunk),
+        )
+        for chunk in split_sequence(batch[4][0])
+    ]
+
+    def generate():
+        streaming_vocoder = StreamingVocoder(vocoder, model_config, preprocess_config)
+        for batch in batchs:
+            batch = to_device(batch, device)
+            with lock, torch.no_grad():
+                output = model(
+                    *(batch[2:]),
+                    p_control=pitch_control,
+                    e_control=energy_control,
+                    d_control=duration_control,
+                )
+                mel_len = output[9][0].item()
+                wavs = streaming_vocoder.push(output[1][0, :mel_len].transpose(0, 1))
+            for wav in wavs:
+                yield wav
 
+        with lock:
+            wav = streaming_vocoder.flush()
+        if wav is not None:
+            yield wav
+
+    return generate()
+
+def synthesize_document(
+    model,
+    configs,
+    vocoder,
+    text,
+    speaker_id,
+    age,
+    control_values,
+    batch_size=8,
+    max_tokens=4000,
+    pause=0.3,
+):
+    """ Synthesize a long text sentence by sentence, batching sentences of similar length,
+    and return the concatenated int16 wav with pause seconds of silence between sentences """
+    preprocess_config, model_config, train_config = configs
+
+    sentences, sequences = [], []
+    for sentence in split_text(text, ".?!"):
+        sequence = preprocess_english(sentence, preprocess_config)
+        # Sentences longer than the positional encoding are split further at clauses
+        if len(sequence) > model_config["max_seq_len"]:
+            for clause in split_text(sentence):
+                sentences.append(clause)
+                sequences.append(preprocess_english(clause, preprocess_config))
+        else:
+            sentences.append(sentence)
+            sequences.append(sequence)
+
+    sampler = LengthBucketBatchSampler(
+        [len(sequence) for sequence in sequences], max_tokens, max_batch_size=batch_size
+    )
+    order = []
+    batchs = []
+    for idx in sampler:
+        order += idx
+        texts = [sequences[j] for j in idx]
+        text_lens = np.array([len(sequence) for sequence in texts])
+        batchs.append(
+            (
+                [str(j) for j in idx],
+                [sentences[j][:100] for j in idx],
+                np.array([speaker_id] * len(idx)),
+                np.array([age] * len(idx)),
+                pad_1D(texts),
+                text_lens,
+                max(text_lens),
+            )
+        )
+
+    wavs = synthesize(
+        model, None, configs, vocoder, batchs, control_values, save_outputs=False
+    )
+    wavs = [wav for _, wav in sorted(zip(order, wavs), key=lambda x: x[0])]
+
+    sampling_rate = preprocess_config["preprocessing"]["audio"]["sampling_rate"]
+    silence = np.zeros(int(pause * sampling_rate), dtype=np.int16)
+    output = []
+    for i, wav in enumerate(wavs):
+        if i > 0:
+            output.append(silence)
+        output.append(wav)
+    return np.concatenate(output) if output else silence[:0]
+
+def synthesize(
+    model,
+    step,
+    configs,
+    vocoder,
+    batchs,
+    control_values,
+    save_outputs=True,
+    plotter=None,
+    writer=None,
+    age_sweep=None,
+    age_vector=None,
+    conditioning_cache=None,
+    vocoder_cache=None,
+):
+    """ Synthesize the batches and return the waveforms. With age_sweep, a list of
+    age groups, every sentence is synthesized once per age group, sharing the
+    encoder pass, and the outputs are named <basename>_<age group>.
+    age_vector, e.g. from an AgeConditioningTable, replaces the age of the batches.
+    With a ConditioningCache, the speaker and age vectors are looked up instead of recomputed,
+    and with a VocoderCache, mels that were already vocoded are read from disk """
+    preprocess_config, model_config, train_config = configs
+    pitch_control, energy_control, duration_control = control_values
+    result_path = train_config["path"]["result_path"] if save_outputs else None
+    if age_sweep is not None:
+        sweep_ages = torch.LongTensor(
+            [map_age_to_idx(age, preprocess_config) for age in age_sweep]
+        ).to(device)
+
+    wavs = []
     for batch in batchs:
         batch = to_device(batch, device)
         with torch.no_grad():    
             # Forward
-            output = model(
-                *(batch[2:]),
-                p_control=pitch_control,
-                e_control=energy_control,
-                d_control=duration_control,
-            )
-            synth_samples(
-                batch,
+            if age_sweep is None:
+                output = model(
+                    *(batch[2:]),
+                    p_control=pitch_control,
+                    e_control=energy_control,
+                    d_control=duration_control,
+                    age_vectors=(
+                        age_vector.unsqueeze(0).expand(len(batch[0]), -1)
+                        if age_vector is not None
+                        else None
+                    ),
+                    conditioning=(
+                        conditioning_cache.get(batch[2], batch[3])
+                        if conditioning_cache is not None and age_vector is None
+                        else None
+                    ),
+                )
+                targets = batch
+            else:
+                output = model.forward_age_sweep(
+                    batch[2],
+                    sweep_ages,
+                    batch[4],
+                    batch[5],
+                    batch[6],
+                    p_control=pitch_control,
+                    e_control=energy_control,
+                    d_control=duration_control,
+                )
+                targets = (
+                    [
+                        "{}_{}".format(basename, age)
+                        for basename in batch[0]
+                        for age in age_sweep
+                    ],
+                )
+            wavs += synth_samples(
+                targets,
                 output,
                 vocoder,
                 model_config,
                 preprocess_config,
-                train_config["path"]["result_path"],
+                result_path,
+                plotter=plotter if save_outputs else None,
+                writer=writer,
+                vocoder_cache=vocoder_cache,
             )
 
+    return wavs
+
 
 if __name__ == "__main__":
 
@@ -118,21 +307,21 @@ if __name__ == "__main__":
     parser.add_argument(
         "--mode",
         type=str,
-        choices=["batch", "single"],
+        choices=["batch", "single", "document"],
         required=True,
-        help="Synthesize a whole dataset or a single sentence",
+        help="Synthesize a whole dataset, a single sentence or a long document",
     )
     parser.add_argument(
         "--source",
         type=str,
         default=None,
-        help="path to a source file with format like train.txt and val.txt, for batch mode only",
+        help="path to a source file with format like train.txt and val.txt for batch mode, or to a plain text file for document mode",
     )
     parser.add_argument(
         "--text",
         type=str,
         default=None,
-        help="raw text to synthesize, for single-sentence mode only",
+        help="raw text to synthesize, for single-sentence and document mode",
     )
     parser.add_argument(
         "--speaker_id",
@@ -177,6 +366,124 @@ if __name__ == "__main__":
         default=None,
         help="control the age of the speaker",
     )
+    parser.add_argument(
+        "--age_value",
+        type=float,
+        default=None,
+        help="continuous age control: position on the axis of age group ids in ages.json, e.g. 1.5 is halfway between the groups with ids 1 and 2",
+    )
+    parser.add_argument(
+        "--age_weights",
+        type=str,
+        default=None,
+        help="mix of age groups, e.g. child:0.3,adult:0.7",
+    )
+    parser.add_argument(
+        "--age_sweep",
+        type=str,
+        default=None,
+        help="comma separated age groups (e.g. child,adult,senior): synthesize every sentence with each of them, for single and batch mode",
+    )
+    parser.add_argument(
+        "--plot",
+        action="store_true",
+        help="also save a png with the synthesized spectrogram, pitch and energy of each utterance",
+    )
+    parser.add_argument(
+        "--plot_workers",
+        type=int,
+        default=2,
+        help="number of background processes drawing the spectrograms, 0 to draw them in the main process",
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        choices=["wav", "flac", "pcm"],
+        default="wav",
+        help="format of the synthesized audio: one wav or flac file per utterance, or raw 16-bit PCM shards",
+    )
+    parser.add_argument(
+        "--writer_workers",
+        type=int,
+        default=2,
+        help="number of background threads writing the synthesized audio",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=8,
+        help="maximum number of sentences synthesized together, for batch and document mode",
+    )
+    parser.add_argument(
+        "--max_tokens",
+        type=int,
+        default=4000,
+        help="maximum number of (padded) phonemes per batch, for batch and document mode",
+    )
+    parser.add_argument(
+        "--pause",
+        type=float,
+        default=0.3,
+        help="silence in seconds inserted between sentences, for document mode only",
+    )
+    parser.add_argument(
+        "--exported",
+        type=str,
+        default=None,
+        help="directory with the TorchScript or ONNX models saved by export.py, used instead of the checkpoint",
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="run on CPU with the int8 model, created and cached next to the checkpoint on first use",
+    )
+    parser.add_argument(
+        "--bucket",
+        action="store_true",
+        help="pad the inputs to fixed text and mel lengths and reuse a compiled model per bucket",
+    )
+    parser.add_argument(
+        "--text_buckets",
+        type=str,
+        default="16,32,64,128,256",
+        help="comma separated phoneme lengths of the buckets, for --bucket",
+    )
+    parser.add_argument(
+        "--mel_buckets",
+        type=str,
+        default="128,256,512,1000",
+        help="comma separated mel lengths of the buckets, for --bucket",
+    )
+    parser.add_argument(
+        "--vocoder",
+        type=str,
+        default=None,
+        help="vocoder to use instead of the one of model.yaml, e.g. Griffin-Lim for fast draft-quality previews",
+    )
+    parser.add_argument(
+        "--vocoder_cache",
+        type=str,
+        default=None,
+        help="directory of a cache of vocoded waveforms, reused when the same mels are synthesized again",
+    )
+    parser.add_argument(
+        "--vocoder_cache_size",
+        type=float,
+        default=1024,
+        help="maximum size of the vocoder cache in MB",
+    )
+    parser.add_argument(
+        "--utterance_cache",
+        type=str,
+        default=None,
+        help="directory of a cache of synthesized sentences, reused when the same request is repeated, for single mode",
+    )
+    parser.add_argument(
+        "--utterance_cache_ttl",
+        type=float,
+        default=None,
+        help="time in seconds after which a cached sentence is synthesized again",
+    )
     args = parser.parse_args()
         
     # Check source texts
@@ -184,6 +491,8 @@ if __name__ == "__main__":
         assert args.source is not None and args.text is None
     if args.mode == "single":
         assert args.source is None and args.text is not None
+    if args.mode == "document":
+        assert (args.source is None) != (args.text is None)
 
     # Read Config
     preprocess_config = yaml.load(
@@ -193,11 +502,44 @@ if __name__ == "__main__":
     train_config = yaml.load(open(args.train_config, "r"), Loader=yaml.FullLoader)
     configs = (preprocess_config, model_config, train_config)
 
-    # Get model
-    model = get_model(args, configs, device, train=False)
+    if args.mode == "document":
+        # Documents are synthesized with an age group id, without the caches and plots
+        if (
+            args.age_value is not None
+            or args.age_weights is not None
+            or args.age_sweep is not None
+            or args.vocoder_cache is not None
+            or args.utterance_cache is not None
+            or args.plot
+        ):
+            print("Error: --age_value, --age_weights, --age_sweep, --vocoder_cache, --utterance_cache and --plot are not supported in document mode.")
+            exit(1)
+
+    if args.exported is not None:
+        # Exported models only take age and speaker ids
+        if args.age_value is not None or args.age_weights is not None or args.age_sweep is not None:
+            print("Error: --age_value, --age_weights and --age_sweep are not supported with --exported.")
+            exit(1)
+        model, vocoder = get_exported_model(args.exported, device)
+        if args.vocoder is not None:
+            vocoder = get_vocoder(
+                model_config, device, name=args.vocoder, preprocess_config=preprocess_config
+            )
+    elif args.quantize:
+        # Dynamically quantized layers only run on CPU
+        device = torch.device("cpu")
+        model = get_quantized_model(args, configs)
+        vocoder = get_vocoder(
+            model_config, device, name=args.vocoder, preprocess_config=preprocess_config
+        )
+    else:
+        # Get model
+        model = get_model(args, configs, device, train=False)
 
-    # Load vocoder
-    vocoder = get_vocoder(model_config, device)
+        # Load vocoder
+        vocoder = get_vocoder(
+            model_config, device, name=args.vocoder, preprocess_config=preprocess_config
+        )
     
     # Check age control argument
     with open(f'{preprocess_config["path"]["preprocessed_path"]}/ages.json') as f:
@@ -210,6 +552,77 @@ if __name__ == "__main__":
         else:
             print(f"Perceived syntehsised age: {args.age_control}")
     
+    age_sweep = None
+    if args.age_sweep is not None:
+        if args.age_value is not None or args.age_weights is not None:
+            print("Error: --age_sweep cannot be combined with --age_value or --age_weights.")
+            exit(1)
+        age_sweep = [age.strip().lower() for age in args.age_sweep.split(",")]
+        for age in age_sweep:
+            if age not in ages_id_map:
+                print(f"Error: Invalid age group '{age}'. Please choose from: {list(ages_id_map.keys())}.")
+                exit(1)
+    
+    age_vector = None
+    if args.age_value is not None or args.age_weights is not None:
+        age_table = AgeConditioningTable(model)
+        if args.age_value is not None:
+            age_vector = age_table.lookup(args.age_value)
+        else:
+            weights = [0.0] * len(ages_id_map)
+            for item in args.age_weights.split(","):
+                age, _, weight = item.partition(":")
+                age = age.strip().lower()
+                if age not in ages_id_map:
+                    print(f"Error: Invalid age group '{age}'. Please choose from: {list(ages_id_map.keys())}.")
+                    exit(1)
+                try:
+                    weights[ages_id_map[age]] = float(weight)
+                except ValueError:
+                    print(f"Error: Invalid age weight '{item.strip()}', expected group:weight, e.g. child:0.3,adult:0.7.")
+                    exit(1)
+            if min(weights) < 0:
+                print("Error: The age weights must not be negative.")
+                exit(1)
+            if sum(weights) == 0:
+                print("Error: The age weights sum to zero.")
+                exit(1)
+            age_vector = age_table.mix(weights)
+
+    conditioning_cache = ConditioningCache(model) if args.exported is None else None
+    vocoder_cache = None
+    if args.vocoder_cache is not None:
+        vocoder_cache = VocoderCache(
+            args.vocoder_cache,
+            get_vocoder_id(model_config, args.vocoder)
+            if args.exported is None or args.vocoder is not None
+            else os.path.abspath(args.exported),
+            max_size=int(args.vocoder_cache_size * 1024 ** 2),
+        )
+    utterance_cache = None
+    if args.utterance_cache is not None:
+        utterance_cache = UtteranceCache(
+            "{}:{}:{}".format(
+                os.path.join(train_config["path"]["ckpt_path"], str(args.restore_step))
+                if args.exported is None
+                else os.path.abspath(args.exported),
+                get_vocoder_id(model_config, args.vocoder),
+                "int8" if args.quantize else "float",
+            ),
+            maxsize=0,
+            path=args.utterance_cache,
+            ttl=args.utterance_cache_ttl,
+        )
+    if args.bucket:
+        if args.exported is not None or age_sweep is not None:
+            print("Error: --bucket is not supported with --exported or --age_sweep.")
+            exit(1)
+        model = BucketedModel(
+            model,
+            [int(b) for b in args.text_buckets.split(",")],
+            [int(b) for b in args.mel_buckets.split(",")],
+        )
+    
     # Check speaker id validity
     with open(f'{preprocess_config["path"]["preprocessed_path"]}/speakers.json') as f:
         speaker_id_map = json.load(f)
@@ -226,22 +639,91 @@ if __name__ == "__main__":
         dataset = TextDataset(args.source, preprocess_config)
         batchs = DataLoader(
             dataset,
-            batch_size=8,
+            batch_sampler=LengthBucketBatchSampler(
+                dataset.get_lengths(), args.max_tokens, max_batch_size=args.batch_size
+            ),
             collate_fn=dataset.collate_fn,
         )
 
-    if args.mode == "single":
-        ids = raw_texts = [args.text[:100]]
-        speakers = np.array([speaker_id])
-        if preprocess_config["preprocessing"]["text"]["language"] == "en":
-            texts = np.array([preprocess_english(args.text, preprocess_config)])
-        text_lens = np.array([len(texts[0])])
+    if args.mode in ["single", "document"]:
         if args.age_control is None:
-            age = np.array([map_age_to_idx('adult')])
+            age = map_age_to_idx('adult', preprocess_config)
         if args.age_control is not None:
-            age = np.array([map_age_to_idx(args.age_control)])
-        batchs = [(ids, raw_texts, speakers, age, texts, text_lens, max(text_lens))]
+            age = map_age_to_idx(args.age_control, preprocess_config)
+
+    if args.mode == "single":
+        batchs = [prepare_single_batch(args.text, speaker_id, age, preprocess_config)]
 
     control_values = args.pitch_control, args.energy_control, args.duration_control
 
-    synthesize(model, args.restore_step, configs, vocoder, batchs, control_values)
\ No newline at end of file
+    if args.mode == "document":
+        if args.source is not None:
+            with open(args.source, "r", encoding="utf-8") as f:
+                text = " ".join(line.strip() for line in f)
+            basename = os.path.splitext(os.path.basename(args.source))[0]
+        else:
+            text = args.text
+            basename = args.text[:100]
+        wav = synthesize_document(
+            model,
+            configs,
+            vocoder,
+            text,
+            speaker_id,
+            age,
+            control_values,
+            batch_size=args.batch_size,
+            max_tokens=args.max_tokens,
+            pause=args.pause,
+        )
+        writer = WavWriter(
+            train_config["path"]["result_path"],
+            preprocess_config["preprocessing"]["audio"]["sampling_rate"],
+            output_format=args.output_format,
+            n_workers=args.writer_workers,
+        )
+        writer.write(basename, wav)
+        writer.close()
+    else:
+        plotter = None
+        if args.plot:
+            plotter = MelPlotter(
+                preprocess_config, train_config["path"]["result_path"], args.plot_workers
+            )
+        writer = WavWriter(
+            train_config["path"]["result_path"],
+            preprocess_config["preprocessing"]["audio"]["sampling_rate"],
+            output_format=args.output_format,
+            n_workers=args.writer_workers,
+        )
+        utterance_key = None
+        if utterance_cache is not None and args.mode == "single" and age_sweep is None:
+            age_key = age if age_vector is None else (args.age_value, args.age_weights)
+            utterance_key = utterance_cache.key(
+                batchs[0][4][0], speaker_id, age_key, control_values
+            )
+            wav = utterance_cache.get(utterance_key)
+            if wav is not None:
+                writer.write(batchs[0][0][0], wav)
+                batchs = []
+        wavs = synthesize(
+            model,
+            args.restore_step,
+            configs,
+            vocoder,
+            batchs,
+            control_values,
+            plotter=plotter,
+            writer=writer,
+            age_sweep=age_sweep,
+            age_vector=age_vector,
+            conditioning_cache=conditioning_cache,
+            vocoder_cache=vocoder_cache,
+        )
+        if utterance_key is not None and wavs:
+            utterance_cache.put(utterance_key, wavs[0])
+        writer.close()
+        if plotter is not None:
+            plotter.close()
+        if vocoder_cache is not None:
+            print("Vocoder cache: {}".format(vocoder_cache.stats()))
\ No newline at end of file
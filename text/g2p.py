@@ -0,0 +1,92 @@
+""" Memoized grapheme-to-phoneme fallback for words missing from the lexicon """
+import os
+import json
+import atexit
+import threading
+from collections import OrderedDict
+
+import eng_to_ipa as ipa
+
+
+_g2p_caches = {}
+_g2p_caches_lock = threading.Lock()
+
+
+def word_to_ipa(word):
+    """ IPA phones of a word, without the stress marks """
+    return [s for s in ipa.convert(word) if s != "'" and not s.isspace()]
+
+
+class G2PCache:
+    """Bounded, thread-safe LRU cache in front of the IPA conversion.
+
+    If path is given, the cache is loaded from it and written back to it when
+    the process exits, so recurring out-of-lexicon words are converted once.
+    """
+
+    def __init__(self, maxsize=10000, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if path is not None:
+            self.load(path)
+            atexit.register(self.save, path)
+
+    def convert(self, word):
+        with self.lock:
+            if word in self.cache:
+                self.cache.move_to_end(word)
+                self.hits += 1
+                return list(self.cache[word])
+            self.misses += 1
+
+        phones = word_to_ipa(word)
+
+        with self.lock:
+            self.cache[word] = phones
+            self.cache.move_to_end(word)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return list(phones)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total > 0 else 0.0,
+                "size": len(self.cache),
+            }
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            entries = json.load(f)
+        with self.lock:
+            for word, phones in entries.items():
+                self.cache[word] = phones
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+
+    def save(self, path=None):
+        path = path if path is not None else self.path
+        with self.lock:
+            entries = dict(self.cache)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+def get_g2p_cache(path=None, maxsize=10000):
+    """ Return the G2P cache shared by the frontends of this process """
+    with _g2p_caches_lock:
+        if path not in _g2p_caches:
+            _g2p_caches[path] = G2PCache(maxsize=maxsize, path=path)
+        return _g2p_caches[path]
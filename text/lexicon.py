@@ -0,0 +1,158 @@
+""" Indexed pronunciation dictionary shared by the inference frontends """
+import os
+import re
+import mmap
+import struct
+import threading
+from collections import OrderedDict
+
+
+_MAGIC = b"LEXIDX01"
+_HEADER = struct.Struct("<8sQQ")
+_OFFSET = struct.Struct("<Q")
+
+_lexicons = {}
+_lexicons_lock = threading.Lock()
+
+
+def compile_lexicon(lex_path, index_path):
+    """Compile an MFA dictionary into a sorted binary index.
+
+    Layout: header (magic, source mtime, number of entries), a table of
+    entry offsets and the entries themselves, sorted by word, each stored as
+    "word\\tphone phone ...". As in the original read_lexicon, words are
+    lower-cased and the first pronunciation of a word is kept.
+    """
+    lexicon = {}
+    with open(lex_path) as f:
+        for line in f:
+            temp = re.split(r"\s+", line.strip("\n"))
+            word = temp[0]
+            phones = temp[1:]
+            if word.lower() not in lexicon:
+                lexicon[word.lower()] = phones
+
+    entries = [
+        "{}\t{}".format(word, " ".join(lexicon[word])).encode("utf-8")
+        for word in sorted(lexicon, key=lambda w: w.encode("utf-8"))
+    ]
+    header_size = _HEADER.size + _OFFSET.size * (len(entries) + 1)
+    offsets = [header_size]
+    for entry in entries:
+        offsets.append(offsets[-1] + len(entry))
+
+    data = b"".join(
+        [_HEADER.pack(_MAGIC, int(os.path.getmtime(lex_path)), len(entries))]
+        + [_OFFSET.pack(offset) for offset in offsets]
+        + entries
+    )
+    if index_path is not None:
+        tmp_path = "{}.{}.tmp".format(index_path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, index_path)
+    return data
+
+
+class Lexicon:
+    """Read-only, memory-mapped lexicon with a bounded LRU lookup cache.
+
+    The index is built next to the dictionary (lexicon_path + ".idx") the
+    first time it is needed and rebuilt whenever the dictionary changes. If
+    the directory is not writable the index is kept in memory instead.
+    """
+
+    def __init__(self, lex_path, index_path=None, maxsize=10000):
+        self.lex_path = lex_path
+        self.index_path = index_path if index_path is not None else lex_path + ".idx"
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.file = None
+
+        if not self._index_is_valid():
+            try:
+                compile_lexicon(lex_path, self.index_path)
+            except OSError:
+                self.data = compile_lexicon(lex_path, None)
+                self._read_header()
+                return
+
+        self.file = open(self.index_path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._read_header()
+
+    def _index_is_valid(self):
+        if not os.path.exists(self.index_path):
+            return False
+        with open(self.index_path, "rb") as f:
+            header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return False
+        magic, mtime, _ = _HEADER.unpack(header)
+        return magic == _MAGIC and mtime == int(os.path.getmtime(self.lex_path))
+
+    def _read_header(self):
+        _, _, self.n_entries = _HEADER.unpack_from(self.data, 0)
+
+    def _offset(self, i):
+        return _OFFSET.unpack_from(self.data, _HEADER.size + _OFFSET.size * i)[0]
+
+    def _entry(self, i):
+        entry = self.data[self._offset(i) : self._offset(i + 1)]
+        word, _, phones = entry.partition(b"\t")
+        return word, phones
+
+    def _search(self, word):
+        key = word.encode("utf-8")
+        lo, hi = 0, self.n_entries
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_word, phones = self._entry(mid)
+            if mid_word == key:
+                phones = phones.decode("utf-8")
+                return phones.split(" ") if phones else []
+            if mid_word < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def get(self, word, default=None):
+        """ Return the phones of a (lower-cased) word, or default if it is not in the lexicon """
+        with self.lock:
+            if word in self.cache:
+                self.cache.move_to_end(word)
+                return self.cache[word]
+
+        phones = self._search(word)
+        if phones is None:
+            # Out-of-lexicon words are left to the G2P cache, not kept here
+            return default
+
+        with self.lock:
+            self.cache[word] = phones
+            self.cache.move_to_end(word)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return phones
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def __getitem__(self, word):
+        phones = self.get(word)
+        if phones is None:
+            raise KeyError(word)
+        return phones
+
+    def __len__(self):
+        return self.n_entries
+
+
+def get_lexicon(lex_path):
+    """ Return the lexicon for lex_path, loading it only once per process """
+    with _lexicons_lock:
+        if lex_path not in _lexicons:
+            _lexicons[lex_path] = Lexicon(lex_path)
+        return _lexicons[lex_path]
@@ -4,6 +4,7 @@ import torch
 import torch.nn as nn
 import numpy as np
 from torch.nn import functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 from .SubLayers import MultiHeadAttention, PositionwiseFeedForward
 
@@ -11,9 +12,13 @@ from .SubLayers import MultiHeadAttention, PositionwiseFeedForward
 class FFTBlock(torch.nn.Module):
     """FFT Block"""
 
-    def __init__(self, d_model, n_head, d_k, d_v, d_inner, kernel_size, dropout=0.1):
+    def __init__(
+        self, d_model, n_head, d_k, d_v, d_inner, kernel_size, dropout=0.1, fused_attention=False
+    ):
         super(FFTBlock, self).__init__()
-        self.slf_attn = MultiHeadAttention(n_head, d_model, d_k, d_v, dropout=dropout)
+        self.slf_attn = MultiHeadAttention(
+            n_head, d_model, d_k, d_v, dropout=dropout, fused=fused_attention
+        )
         self.pos_ffn = PositionwiseFeedForward(
             d_model, d_inner, kernel_size, dropout=dropout
         )
@@ -126,6 +131,14 @@ class PostNet(nn.Module):
             )
         )
 
+    def fuse_batchnorm(self):
+        """ Fold each BatchNorm into the weights of the preceding convolution, for inference only """
+        assert not self.training
+        for convolution in self.convolutions:
+            if isinstance(convolution[1], nn.BatchNorm1d):
+                convolution[0].conv = fuse_conv_bn_eval(convolution[0].conv, convolution[1])
+                convolution[1] = nn.Identity()
+
     def forward(self, x):
         x = x.contiguous().transpose(1, 2)
 
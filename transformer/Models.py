@@ -1,6 +1,5 @@
 import torch
 import torch.nn as nn
-import numpy as np
 
 import transformer.Constants as Constants
 from .Layers import FFTBlock
@@ -10,24 +9,35 @@ from text.symbols import symbols
 def get_sinusoid_encoding_table(n_position, d_hid, padding_idx=None):
     """ Sinusoid position encoding table """
 
-    def cal_angle(position, hid_idx):
-        return position / np.power(10000, 2 * (hid_idx // 2) / d_hid)
+    position = torch.arange(n_position, dtype=torch.float64).unsqueeze(1)
+    hid_idx = torch.arange(d_hid, dtype=torch.float64)
+    sinusoid_table = position / torch.pow(10000, 2 * torch.floor(hid_idx / 2) / d_hid)
 
-    def get_posi_angle_vec(position):
-        return [cal_angle(position, hid_j) for hid_j in range(d_hid)]
-
-    sinusoid_table = np.array(
-        [get_posi_angle_vec(pos_i) for pos_i in range(n_position)]
-    )
-
-    sinusoid_table[:, 0::2] = np.sin(sinusoid_table[:, 0::2])  # dim 2i
-    sinusoid_table[:, 1::2] = np.cos(sinusoid_table[:, 1::2])  # dim 2i+1
+    sinusoid_table[:, 0::2] = torch.sin(sinusoid_table[:, 0::2])  # dim 2i
+    sinusoid_table[:, 1::2] = torch.cos(sinusoid_table[:, 1::2])  # dim 2i+1
 
     if padding_idx is not None:
         # zero vector for padding dimension
         sinusoid_table[padding_idx] = 0.0
 
-    return torch.FloatTensor(sinusoid_table)
+    return sinusoid_table.float()
+
+
+class SinusoidTableCache:
+    """ Sinusoid tables for sequences longer than max_seq_len at inference.
+    One table is kept per device and doubled in length when a longer sequence arrives """
+
+    def __init__(self, d_hid):
+        self.d_hid = d_hid
+        self.tables = {}
+
+    def get(self, length, device):
+        table = self.tables.get(device)
+        if table is None or table.size(0) < length:
+            n_position = length if table is None else max(length, 2 * table.size(0))
+            table = get_sinusoid_encoding_table(n_position, self.d_hid).to(device)
+            self.tables[device] = table
+        return table[:length]
 
 
 class Encoder(nn.Module):
@@ -49,6 +59,7 @@ class Encoder(nn.Module):
         d_inner = config["transformer"]["conv_filter_size"]
         kernel_size = config["transformer"]["conv_kernel_size"]
         dropout = config["transformer"]["encoder_dropout"]
+        fused_attention = config["transformer"].get("fused_attention", False)
 
         self.max_seq_len = config["max_seq_len"]
         self.d_model = d_model
@@ -60,11 +71,19 @@ class Encoder(nn.Module):
             get_sinusoid_encoding_table(n_position, d_word_vec).unsqueeze(0),
             requires_grad=False,
         )
+        self.long_position_enc = SinusoidTableCache(d_word_vec)
 
         self.layer_stack = nn.ModuleList(
             [
                 FFTBlock(
-                    d_model, n_head, d_k, d_v, d_inner, kernel_size, dropout=dropout
+                    d_model,
+                    n_head,
+                    d_k,
+                    d_v,
+                    d_inner,
+                    kernel_size,
+                    dropout=dropout,
+                    fused_attention=fused_attention,
                 )
                 for _ in range(n_layers)
             ]
@@ -80,11 +99,9 @@ class Encoder(nn.Module):
 
         # -- Forward
         if not self.training and src_seq.shape[1] > self.max_seq_len:
-            enc_output = self.src_word_emb(src_seq) + get_sinusoid_encoding_table(
-                src_seq.shape[1], self.d_model
-            )[: src_seq.shape[1], :].unsqueeze(0).expand(batch_size, -1, -1).to(
-                src_seq.device
-            )
+            enc_output = self.src_word_emb(src_seq) + self.long_position_enc.get(
+                src_seq.shape[1], src_seq.device
+            ).unsqueeze(0).expand(batch_size, -1, -1)
         else:
             enc_output = self.src_word_emb(src_seq) + self.position_enc[
                 :, :max_len, :
@@ -118,6 +135,7 @@ class Decoder(nn.Module):
         d_inner = config["transformer"]["conv_filter_size"]
         kernel_size = config["transformer"]["conv_kernel_size"]
         dropout = config["transformer"]["decoder_dropout"]
+        fused_attention = config["transformer"].get("fused_attention", False)
 
         self.max_seq_len = config["max_seq_len"]
         self.d_model = d_model
@@ -126,11 +144,19 @@ class Decoder(nn.Module):
             get_sinusoid_encoding_table(n_position, d_word_vec).unsqueeze(0),
             requires_grad=False,
         )
+        self.long_position_enc = SinusoidTableCache(d_word_vec)
 
         self.layer_stack = nn.ModuleList(
             [
                 FFTBlock(
-                    d_model, n_head, d_k, d_v, d_inner, kernel_size, dropout=dropout
+                    d_model,
+                    n_head,
+                    d_k,
+                    d_v,
+                    d_inner,
+                    kernel_size,
+                    dropout=dropout,
+                    fused_attention=fused_attention,
                 )
                 for _ in range(n_layers)
             ]
@@ -145,21 +171,21 @@ class Decoder(nn.Module):
         if not self.training and enc_seq.shape[1] > self.max_seq_len:
             # -- Prepare masks
             slf_attn_mask = mask.unsqueeze(1).expand(-1, max_len, -1)
-            dec_output = enc_seq + get_sinusoid_encoding_table(
-                enc_seq.shape[1], self.d_model
-            )[: enc_seq.shape[1], :].unsqueeze(0).expand(batch_size, -1, -1).to(
-                enc_seq.device
-            )
+            dec_output = enc_seq + self.long_position_enc.get(
+                enc_seq.shape[1], enc_seq.device
+            ).unsqueeze(0).expand(batch_size, -1, -1)
         else:
-            max_len = min(max_len, self.max_seq_len)
+            # Only truncate when needed, so that traced models keep dynamic lengths
+            if max_len > self.max_seq_len:
+                max_len = self.max_seq_len
+                enc_seq = enc_seq[:, :max_len, :]
+                mask = mask[:, :max_len]
 
             # -- Prepare masks
             slf_attn_mask = mask.unsqueeze(1).expand(-1, max_len, -1)
-            dec_output = enc_seq[:, :max_len, :] + self.position_enc[
+            dec_output = enc_seq + self.position_enc[
                 :, :max_len, :
             ].expand(batch_size, -1, -1)
-            mask = mask[:, :max_len]
-            slf_attn_mask = slf_attn_mask[:, :, :max_len]
 
         for dec_layer in self.layer_stack:
             dec_output, dec_slf_attn = dec_layer(
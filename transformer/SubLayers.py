@@ -1,3 +1,4 @@
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
@@ -8,12 +9,15 @@ from .Modules import ScaledDotProductAttention
 class MultiHeadAttention(nn.Module):
     """ Multi-Head Attention module """
 
-    def __init__(self, n_head, d_model, d_k, d_v, dropout=0.1):
+    def __init__(self, n_head, d_model, d_k, d_v, dropout=0.1, fused=False):
         super().__init__()
 
         self.n_head = n_head
         self.d_k = d_k
         self.d_v = d_v
+        self.fused = fused
+        self.qkv = None
+        self.qkv_version = None
 
         self.w_qs = nn.Linear(d_model, n_head * d_k)
         self.w_ks = nn.Linear(d_model, n_head * d_k)
@@ -28,6 +32,9 @@ class MultiHeadAttention(nn.Module):
 
     def forward(self, q, k, v, mask=None):
 
+        if self.fused:
+            return self.fused_forward(q, k, v, mask=mask)
+
         d_k, d_v, n_head = self.d_k, self.d_v, self.n_head
 
         sz_b, len_q, _ = q.size()
@@ -56,6 +63,68 @@ class MultiHeadAttention(nn.Module):
 
         return output, attn
 
+    def qkv_projection(self):
+        """ Weight and bias of w_qs, w_ks and w_vs concatenated. Without gradients they are
+        cached until the projections change (e.g. a checkpoint is loaded or the model is moved) """
+        params = [self.w_qs.weight, self.w_ks.weight, self.w_vs.weight]
+        params += [self.w_qs.bias, self.w_ks.bias, self.w_vs.bias]
+        if torch.is_grad_enabled() and any(param.requires_grad for param in params):
+            return torch.cat(params[:3]), torch.cat(params[3:])
+
+        version = tuple((param.data_ptr(), param._version) for param in params)
+        if version != self.qkv_version:
+            with torch.no_grad():
+                self.qkv = (torch.cat(params[:3]), torch.cat(params[3:]))
+            self.qkv_version = version
+        return self.qkv
+
+    def fused_forward(self, q, k, v, mask=None):
+        """ Same computation as forward, with a single QKV projection for self-attention,
+        the mask broadcast over the heads and PyTorch's fused attention kernel when available
+        (in which case the attention weights are not returned) """
+
+        d_k, d_v, n_head = self.d_k, self.d_v, self.n_head
+
+        sz_b, len_q, _ = q.size()
+        sz_b, len_k, _ = k.size()
+
+        residual = q
+
+        # The projections are not concatenated once quantized (weight is then a method)
+        if q is k and k is v and isinstance(self.w_qs.weight, torch.Tensor):
+            weight, bias = self.qkv_projection()
+            q, k, v = F.linear(q, weight, bias).split(
+                [n_head * d_k, n_head * d_k, n_head * d_v], dim=-1
+            )
+        else:
+            q, k, v = self.w_qs(q), self.w_ks(k), self.w_vs(v)
+        q = q.view(sz_b, len_q, n_head, d_k).transpose(1, 2)  # b x n x lq x dk
+        k = k.view(sz_b, len_k, n_head, d_k).transpose(1, 2)  # b x n x lk x dk
+        v = v.view(sz_b, len_k, n_head, d_v).transpose(1, 2)  # b x n x lv x dv
+
+        if mask is not None:
+            mask = mask.unsqueeze(1)  # b x 1 x lq x lk
+
+        if hasattr(F, "scaled_dot_product_attention"):
+            output = F.scaled_dot_product_attention(
+                q, k, v, attn_mask=~mask if mask is not None else None
+            )
+            attn = None
+        else:
+            attn = torch.matmul(q, k.transpose(2, 3)) / self.attention.temperature
+            if mask is not None:
+                attn = attn.masked_fill(mask, -np.inf)
+            attn = torch.softmax(attn, dim=-1)
+            output = torch.matmul(attn, v)
+            attn = attn.transpose(0, 1).reshape(-1, len_q, len_k)  # (n*b) x lq x lk
+
+        output = output.transpose(1, 2).reshape(sz_b, len_q, -1)  # b x lq x (n*dv)
+
+        output = self.dropout(self.fc(output))
+        output = self.layer_norm(output + residual)
+
+        return output, attn
+
 
 class PositionwiseFeedForward(nn.Module):
     """ A two-feed-forward-layer module """
@@ -91,3 +160,27 @@ class PositionwiseFeedForward(nn.Module):
         output = self.layer_norm(output + residual)
 
         return output
+
+
+if __name__ == "__main__":
+    # Check that the fused attention matches the original implementation
+    torch.manual_seed(0)
+    attention = MultiHeadAttention(2, 256, 128, 128)
+    attention.eval()
+
+    x = torch.randn(3, 50, 256)
+    lengths = torch.LongTensor([50, 31, 7])
+    mask = torch.arange(50).unsqueeze(0) >= lengths.unsqueeze(1)
+    slf_attn_mask = mask.unsqueeze(1).expand(-1, 50, -1)
+
+    with torch.no_grad():
+        output, attn = attention(x, x, x, mask=slf_attn_mask)
+        attention.fused = True
+        fused_output, fused_attn = attention(x, x, x, mask=slf_attn_mask)
+
+    print("max abs difference of the outputs: {:.2e}".format(
+        (output - fused_output).abs().max().item()
+    ))
+    assert torch.allclose(output, fused_output, atol=1e-5)
+    if fused_attn is not None:
+        assert torch.allclose(attn, fused_attn, atol=1e-6)
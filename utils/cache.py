@@ -0,0 +1,200 @@
+""" Caches of synthesis results shared by the inference scripts """
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class VocoderCache:
+    """Content-addressed disk cache of vocoded waveforms.
+
+    The key of a mel is the hash of its values rounded to decimals places and of
+    the vocoder id, so that the same mel vocoded by another vocoder checkpoint is not
+    reused. Waveforms are stored as int16 .npy files, and the least recently used
+    ones are deleted when the cache grows beyond max_size bytes.
+    """
+
+    def __init__(self, path, vocoder_id, max_size=1024 ** 3, decimals=3):
+        self.path = path
+        self.vocoder_id = vocoder_id
+        self.max_size = max_size
+        self.decimals = decimals
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(path, exist_ok=True)
+        self.size = sum(size for _, _, size in self.entries())
+
+    def entries(self):
+        """ (mtime, path, size) of the cached waveforms """
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(".npy"):
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, os.path.join(self.path, name), stat.st_size))
+        return entries
+
+    def key(self, mel):
+        """ Key of a mel (n_mel_channels x frames tensor), without padding frames """
+        mel = np.round(mel.detach().cpu().numpy().astype("float64") * 10 ** self.decimals)
+        digest = hashlib.sha1(self.vocoder_id.encode("utf-8"))
+        digest.update(str(mel.shape).encode("utf-8"))
+        digest.update(mel.astype("int32").tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        path = os.path.join(self.path, key + ".npy")
+        try:
+            wav = np.load(path)
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return wav
+
+    def put(self, key, wav):
+        path = os.path.join(self.path, key + ".npy")
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            np.save(f, wav.astype("int16"))
+        with self.lock:
+            if os.path.exists(path):
+                self.size -= os.path.getsize(path)
+            os.replace(tmp_path, path)
+            self.size += os.path.getsize(path)
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """ Delete the least recently used waveforms until the cache fits in 90% of max_size """
+        entries = sorted(self.entries())
+        self.size = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if self.size <= 0.9 * self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total > 0 else 0.0,
+                "size": self.size,
+            }
+
+
+class UtteranceCache:
+    """In-memory LRU cache of synthesized utterances, with an optional disk tier.
+
+    The key is the phoneme sequence of the text with the speaker, the age,
+    the control values and the vocoder, and the model id, so that the outputs
+    of another checkpoint or vocoder are not reused. Entries older than ttl seconds, if
+    given, are synthesized again.
+    """
+
+    def __init__(self, model_id, maxsize=1000, path=None, ttl=None):
+        self.model_id = model_id
+        self.maxsize = maxsize
+        self.path = path
+        self.ttl = ttl
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def key(self, sequence, speaker, age, control_values, vocoder=None):
+        digest = hashlib.sha1(self.model_id.encode("utf-8"))
+        digest.update(
+            repr(
+                (
+                    [int(symbol) for symbol in sequence],
+                    speaker,
+                    age,
+                    [round(float(control), 4) for control in control_values],
+                    vocoder,
+                )
+            ).encode("utf-8")
+        )
+        return digest.hexdigest()
+
+    def expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key):
+        with self.lock:
+            if key in self.cache:
+                created, wav = self.cache[key]
+                if not self.expired(created):
+                    self.cache.move_to_end(key)
+                    self.memory_hits += 1
+                    return wav
+                del self.cache[key]
+
+        if self.path is not None:
+            path = os.path.join(self.path, key + ".npy")
+            try:
+                created = os.path.getmtime(path)
+                if not self.expired(created):
+                    wav = np.load(path)
+                    with self.lock:
+                        self.disk_hits += 1
+                        self.add(key, created, wav)
+                    return wav
+                os.remove(path)
+            except (FileNotFoundError, ValueError):
+                pass
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def add(self, key, created, wav):
+        if self.maxsize <= 0:
+            return
+        self.cache[key] = (created, wav)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
+    def put(self, key, wav):
+        with self.lock:
+            self.add(key, time.time(), wav)
+        if self.path is not None:
+            path = os.path.join(self.path, key + ".npy")
+            tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+            with open(tmp_path, "wb") as f:
+                np.save(f, wav)
+            os.replace(tmp_path, path)
+
+    def stats(self):
+        with self.lock:
+            hits = self.memory_hits + self.disk_hits
+            total = hits + self.misses
+            return {
+                "hits": hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / total if total > 0 else 0.0,
+                "size": len(self.cache),
+            }
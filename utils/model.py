@@ -2,6 +2,8 @@ import os
 import json
 
 import torch
+import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 
 import hifigan
@@ -17,7 +19,7 @@ def get_model(args, configs, device, train=False):
             train_config["path"]["ckpt_path"],
             "{}.pth.tar".format(args.restore_step),
         )
-        ckpt = torch.load(ckpt_path)
+        ckpt = torch.load(ckpt_path, map_location=device)
         model.load_state_dict(ckpt["model"])
 
     if train:
@@ -31,6 +33,48 @@ def get_model(args, configs, device, train=False):
 
     model.eval()
     model.requires_grad_ = False
+    model.postnet.fuse_batchnorm()
+    return model
+
+
+def quantize_model(model):
+    """ Post-training dynamic int8 quantization of the nn.Linear layers, for CPU inference """
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def get_quantized_model(args, configs):
+    """ Int8 model for CPU inference, cached next to the checkpoint as <restore_step>_int8.pth.tar """
+    (preprocess_config, model_config, train_config) = configs
+    device = torch.device("cpu")
+
+    ckpt_path = os.path.join(
+        train_config["path"]["ckpt_path"],
+        "{}.pth.tar".format(args.restore_step),
+    )
+    quantized_path = os.path.join(
+        train_config["path"]["ckpt_path"],
+        "{}_int8.pth.tar".format(args.restore_step),
+    )
+    # The int8 model is rebuilt when the float checkpoint was overwritten since
+    source = (os.path.getsize(ckpt_path), int(os.path.getmtime(ckpt_path)))
+    quantized = None
+    if os.path.exists(quantized_path):
+        quantized = torch.load(quantized_path, map_location=device)
+        if not isinstance(quantized, dict) or quantized.get("source") != source:
+            quantized = None
+
+    if quantized is not None:
+        model = AgingFastSpeech2(preprocess_config, model_config).to(device)
+        model.eval()
+        model.postnet.fuse_batchnorm()
+        model = quantize_model(model)
+        model.load_state_dict(quantized["model"])
+    else:
+        model = quantize_model(get_model(args, configs, device, train=False))
+        torch.save({"source": source, "model": model.state_dict()}, quantized_path)
+
+    model.eval()
+    model.requires_grad_(False)
     return model
 
 
@@ -39,45 +83,144 @@ def get_param_num(model):
     return num_param
 
 
-def get_vocoder(config, device):
-    name = config["vocoder"]["model"]
+VOCODERS = {}
+
+
+def register_vocoder(name, infer):
+    """ Register a vocoder under the name used by vocoder.model in model.yaml.
+    The decorated function load(config, device, preprocess_config) returns the vocoder,
+    and infer(vocoder, mels) its waveforms (batch x samples, in [-1, 1]) """
+
+    def register(load):
+        VOCODERS[name] = {"load": load, "infer": infer}
+        return load
+
+    return register
+
+
+@register_vocoder("MelGAN", lambda vocoder, mels: vocoder.inverse(mels / np.log(10)))
+def load_melgan(config, device, preprocess_config=None):
     speaker = config["vocoder"]["speaker"]
+    if speaker == "LJSpeech":
+        vocoder = torch.hub.load(
+            "descriptinc/melgan-neurips", "load_melgan", "linda_johnson"
+        )
+    elif speaker == "universal":
+        vocoder = torch.hub.load(
+            "descriptinc/melgan-neurips", "load_melgan", "multi_speaker"
+        )
+    vocoder.mel2wav.eval()
+    vocoder.mel2wav.to(device)
+    return vocoder
 
-    if name == "MelGAN":
-        if speaker == "LJSpeech":
-            vocoder = torch.hub.load(
-                "descriptinc/melgan-neurips", "load_melgan", "linda_johnson"
-            )
-        elif speaker == "universal":
-            vocoder = torch.hub.load(
-                "descriptinc/melgan-neurips", "load_melgan", "multi_speaker"
-            )
-        vocoder.mel2wav.eval()
-        vocoder.mel2wav.to(device)
-    elif name == "HiFi-GAN":
-        with open("hifigan/config.json", "r") as f:
-            config = json.load(f)
-        config = hifigan.AttrDict(config)
-        vocoder = hifigan.Generator(config)
-        if speaker == "LJSpeech":
-            ckpt = torch.load("hifigan/generator_LJSpeech.pth.tar")
-        elif speaker == "universal":
-            ckpt = torch.load("hifigan/generator_universal.pth.tar")
-        vocoder.load_state_dict(ckpt["generator"])
-        vocoder.eval()
-        vocoder.remove_weight_norm()
-        vocoder.to(device)
 
+@register_vocoder("HiFi-GAN", lambda vocoder, mels: vocoder(mels).squeeze(1))
+def load_hifigan(config, device, preprocess_config=None):
+    speaker = config["vocoder"]["speaker"]
+    with open("hifigan/config.json", "r") as f:
+        config = json.load(f)
+    config = hifigan.AttrDict(config)
+    vocoder = hifigan.Generator(config)
+    if speaker == "LJSpeech":
+        ckpt = torch.load("hifigan/generator_LJSpeech.pth.tar", map_location=device)
+    elif speaker == "universal":
+        ckpt = torch.load("hifigan/generator_universal.pth.tar", map_location=device)
+    vocoder.load_state_dict(ckpt["generator"])
+    vocoder.eval()
+    vocoder.remove_weight_norm()
+    vocoder.to(device)
     return vocoder
 
 
-def vocoder_infer(mels, vocoder, model_config, preprocess_config, lengths=None):
-    name = model_config["vocoder"]["model"]
+@register_vocoder("Griffin-Lim", lambda vocoder, mels: vocoder(mels))
+def load_griffin_lim(config, device, preprocess_config=None):
+    """ Draft-quality vocoder without weights, e.g. for previews of the controls """
+    from audio.stft import GriffinLim
+
+    if preprocess_config is None:
+        raise ValueError("The Griffin-Lim vocoder needs the preprocessing config.")
+    return GriffinLim(preprocess_config).to(device)
+
+
+def get_vocoder(config, device, name=None, preprocess_config=None):
+    """ Load the vocoder registered as name, by default the one of the model config """
+    name = name if name is not None else config["vocoder"]["model"]
+    if name not in VOCODERS:
+        raise ValueError(
+            "Unknown vocoder '{}'. Please choose from: {}.".format(name, list(VOCODERS.keys()))
+        )
+    vocoder = VOCODERS[name]["load"](config, device, preprocess_config)
+    vocoder.vocoder_name = name
+    return vocoder
+
+
+def get_vocoder_id(config, name=None):
+    """ Identifier of the vocoder weights, e.g. for the keys of a VocoderCache """
+    name = name if name is not None else config["vocoder"]["model"]
+    speaker = config["vocoder"]["speaker"]
+    vocoder_id = "{}_{}".format(name, speaker)
+    if name == "HiFi-GAN":
+        ckpt_path = "hifigan/generator_{}.pth.tar".format(speaker)
+        if os.path.exists(ckpt_path):
+            stat = os.stat(ckpt_path)
+            vocoder_id += "_{}_{}".format(stat.st_size, int(stat.st_mtime))
+    return vocoder_id
+
+
+def group_by_length(mel_lens, tolerance=0.8):
+    """ Split the indices of a batch, sorted by decreasing mel length, into groups whose
+    shortest mel is at least tolerance times the longest one """
+    order = sorted(range(len(mel_lens)), key=lambda i: -mel_lens[i])
+    groups = []
+    for i in order:
+        if groups and mel_lens[i] >= tolerance * mel_lens[groups[-1][0]]:
+            groups[-1].append(i)
+        else:
+            groups.append([i])
+    return groups
+
+
+def vocoder_infer(
+    mels, vocoder, model_config, preprocess_config, lengths=None, mel_lens=None, cache=None
+):
+    """ Vocode a batch of mels (batch x n_mel_channels x frames) into int16 waveforms.
+    With mel_lens, the batch is regrouped by length and each group is cut to its longest
+    mel, so that the padding frames are not vocoded, and the waveforms are trimmed to them.
+    With a VocoderCache, mels that were already vocoded are read from the cache """
+    if cache is not None and mel_lens is None and lengths is None:
+        mel_lens = [mels.size(2)] * len(mels)
+    if mel_lens is not None:
+        mel_lens = [int(mel_len) for mel_len in mel_lens]
+        hop_length = preprocess_config["preprocessing"]["stft"]["hop_length"]
+        wavs = [None] * len(mels)
+
+        keys = {}
+        if cache is not None:
+            for i in range(len(mels)):
+                keys[i] = cache.key(mels[i, :, : mel_lens[i]])
+                wavs[i] = cache.get(keys[i])
+        missing = [i for i in range(len(mels)) if wavs[i] is None]
+
+        for group in group_by_length([mel_lens[i] for i in missing]):
+            group = [missing[i] for i in group]
+            max_len = mel_lens[group[0]]
+            group_wavs = vocoder_infer(
+                mels[group, :, :max_len],
+                vocoder,
+                model_config,
+                preprocess_config,
+                lengths=[mel_lens[i] * hop_length for i in group],
+            )
+            for i, wav in zip(group, group_wavs):
+                wavs[i] = wav
+                if cache is not None:
+                    cache.put(keys[i], wav)
+        return wavs
+
+    # Vocoders loaded by get_vocoder know their name, others follow the model config
+    name = getattr(vocoder, "vocoder_name", model_config["vocoder"]["model"])
     with torch.no_grad():
-        if name == "MelGAN":
-            wavs = vocoder.inverse(mels / np.log(10))
-        elif name == "HiFi-GAN":
-            wavs = vocoder(mels).squeeze(1)
+        wavs = VOCODERS[name]["infer"](vocoder, mels)
 
     wavs = (
         wavs.cpu().numpy()
@@ -90,3 +233,303 @@ def vocoder_infer(mels, vocoder, model_config, preprocess_config, lengths=None):
             wavs[i] = wavs[i][: lengths[i]]
 
     return wavs
+
+
+class StreamingVocoder:
+    """ Vocodes mel frames in fixed-size chunks and emits int16 wav blocks as soon as they are ready.
+
+    Each chunk is vocoded with context frames of the neighbouring mels on both sides, so
+    that its samples see (most of) the receptive field of the vocoder, and the last
+    crossfade frames of a block are cross-faded with the start of the next one. The vocoder
+    only ever runs on chunk_size + 2 * context + crossfade frames, whatever the utterance length """
+
+    def __init__(
+        self, vocoder, model_config, preprocess_config, chunk_size=64, context=8, crossfade=2
+    ):
+        self.vocoder = vocoder
+        self.model_config = model_config
+        self.preprocess_config = preprocess_config
+        self.chunk_size = chunk_size
+        self.context = context
+        self.crossfade = crossfade
+        self.hop_length = preprocess_config["preprocessing"]["stft"]["hop_length"]
+        self.fade_in = np.linspace(0, 1, crossfade * self.hop_length + 2)[1:-1].astype("float32")
+        self.reset()
+
+    def reset(self):
+        self.pending = None  # mel frames not vocoded yet, with their left context
+        self.start = 0  # first frame of pending that has not been emitted
+        self.tail = None  # samples of the previous block to cross-fade with the next one
+
+    def vocode(self, end, n_frames):
+        """ Samples of the frames [start, start + n_frames) of pending, vocoded up to frame end """
+        begin = max(self.start - self.context, 0)
+        wav = vocoder_infer(
+            self.pending[:, begin:end].unsqueeze(0),
+            self.vocoder,
+            self.model_config,
+            self.preprocess_config,
+        )[0].astype("float32")
+        offset = (self.start - begin) * self.hop_length
+        block = wav[offset : offset + n_frames * self.hop_length]
+
+        if self.tail is not None:
+            n = min(len(self.tail), len(block))
+            block[:n] = self.tail[:n] * (1 - self.fade_in[:n]) + block[:n] * self.fade_in[:n]
+        return block
+
+    def push(self, mel):
+        """ Add mel frames (n_mel_channels x frames) and return the wav blocks that are ready """
+        self.pending = mel if self.pending is None else torch.cat([self.pending, mel], dim=1)
+
+        blocks = []
+        step = self.chunk_size + self.crossfade
+        while self.pending.size(1) >= self.start + step + self.context:
+            block = self.vocode(self.start + step + self.context, step)
+            self.tail = block[self.chunk_size * self.hop_length :]
+            blocks.append(block[: self.chunk_size * self.hop_length].astype("int16"))
+            self.start += self.chunk_size
+
+            # Drop the frames that are no longer needed as left context
+            keep_from = max(self.start - self.context, 0)
+            self.pending = self.pending[:, keep_from:]
+            self.start -= keep_from
+        return blocks
+
+    def flush(self):
+        """ Vocode the remaining frames and return the last wav block """
+        block = None
+        if self.pending is not None and self.pending.size(1) > self.start:
+            n_frames = self.pending.size(1) - self.start
+            block = self.vocode(self.pending.size(1), n_frames).astype("int16")
+        self.reset()
+        return block
+
+    def stream(self, mels):
+        """ Vocode an iterable of mel chunks (n_mel_channels x frames) and yield int16 wav blocks """
+        for mel in mels:
+            for block in self.push(mel):
+                yield block
+        block = self.flush()
+        if block is not None:
+            yield block
+
+
+class ExportedModel:
+    """ Runner for a model saved by export.py, either TorchScript (.pt) or ONNX (.onnx).
+    It is called like AgingFastSpeech2 at inference and returns torch tensors on device.
+    The exported graph supports text and mel lengths up to max_seq_len """
+
+    def __init__(self, path, device):
+        self.path = path
+        self.device = device
+        if path.endswith(".onnx"):
+            import onnxruntime
+
+            providers = ["CPUExecutionProvider"]
+            if device.type == "cuda":
+                providers.insert(0, "CUDAExecutionProvider")
+            self.session = onnxruntime.InferenceSession(path, providers=providers)
+            self.module = None
+        else:
+            self.session = None
+            self.module = torch.jit.load(path, map_location=device)
+            self.module.eval()
+
+    def eval(self):
+        return self
+
+    def run(self, *inputs):
+        if self.module is not None:
+            with torch.no_grad():
+                return self.module(*inputs)
+        feeds = {
+            node.name: tensor.cpu().numpy()
+            for node, tensor in zip(self.session.get_inputs(), inputs)
+        }
+        outputs = self.session.run(None, feeds)
+        return tuple(torch.from_numpy(output).to(self.device) for output in outputs)
+
+
+class ExportedAcousticModel(ExportedModel):
+    def __call__(
+        self,
+        speakers,
+        ages,
+        texts,
+        src_lens,
+        max_src_len,
+        p_control=1.0,
+        e_control=1.0,
+        d_control=1.0,
+        age_vectors=None,
+        conditioning=None,
+    ):
+        if age_vectors is not None or conditioning is not None:
+            raise ValueError("Exported models only support age and speaker ids")
+        controls = [
+            torch.tensor(float(control), device=self.device)
+            for control in (p_control, e_control, d_control)
+        ]
+        return self.run(speakers, ages, texts[:, :max_src_len], src_lens, *controls)
+
+
+class ExportedVocoder(ExportedModel):
+    def __call__(self, mels):
+        return self.run(mels)[0] if self.session is not None else self.run(mels)
+
+
+def get_exported_model(export_dir, device):
+    """ Load the acoustic model and the vocoder saved by export.py in export_dir """
+    for ext in [".pt", ".onnx"]:
+        acoustic_path = os.path.join(export_dir, "acoustic_model" + ext)
+        vocoder_path = os.path.join(export_dir, "vocoder" + ext)
+        if os.path.exists(acoustic_path) and os.path.exists(vocoder_path):
+            return (
+                ExportedAcousticModel(acoustic_path, device),
+                ExportedVocoder(vocoder_path, device),
+            )
+    raise FileNotFoundError("No exported models found in {}".format(export_dir))
+
+
+class BucketedModel:
+    """ Runs the acoustic model on inputs padded to a few fixed text and mel lengths,
+    so that each compiled (torch.compile, or torch.jit.trace on older versions) graph is
+    reused by every batch of the same bucket. It is called like AgingFastSpeech2 at inference.
+
+    Stage A encodes the padded text and predicts the durations. The longest predicted
+    utterance selects the mel bucket, and stage B expands, decodes and refines the mels up
+    to the bucket length. The outputs are trimmed to the lengths of the batch.
+    Batches that do not fit in the largest buckets run the model eagerly """
+
+    def __init__(self, model, text_buckets, mel_buckets):
+        self.model = model
+        self.text_buckets = sorted(text_buckets)
+        self.mel_buckets = sorted(mel_buckets)
+        self.encoders = {}
+        self.decoders = {}
+
+    def eval(self):
+        return self
+
+    def encode(self, conditioning, texts, src_lens, d_control):
+        """ Stage A: encoder, speaker and age conditioning and duration prediction """
+        model = self.model
+        output, src_masks = model.encode(texts, src_lens, texts.size(1))
+        output = model.add_conditioning(output, conditioning)
+        log_d_predictions = model.variance_adaptor.duration_predictor(output, src_masks)
+        d_rounded = torch.clamp(
+            torch.round(torch.exp(log_d_predictions) - 1) * d_control, min=0
+        )
+        return output, src_masks, d_rounded
+
+    def compile(self, fn, inputs):
+        if hasattr(torch, "compile"):
+            return torch.compile(fn, dynamic=False)
+        return torch.jit.trace(fn, inputs, check_trace=False)
+
+    def run(self, graphs, key, fn, inputs):
+        if key not in graphs:
+            graphs[key] = self.compile(fn, inputs)
+        return graphs[key](*inputs)
+
+    def __call__(
+        self,
+        speakers,
+        ages,
+        texts,
+        src_lens,
+        max_src_len,
+        p_control=1.0,
+        e_control=1.0,
+        d_control=1.0,
+        age_vectors=None,
+        conditioning=None,
+    ):
+        model = self.model
+        batch_size = texts.size(0)
+        text_bucket = next((b for b in self.text_buckets if b >= max_src_len), None)
+        if text_bucket is None:
+            return model(
+                speakers,
+                ages,
+                texts,
+                src_lens,
+                max_src_len,
+                p_control=p_control,
+                e_control=e_control,
+                d_control=d_control,
+                age_vectors=age_vectors,
+                conditioning=conditioning,
+            )
+
+        # Controls are given as tensors so that they do not specialize the graphs
+        p_control, e_control, d_control = [
+            torch.tensor(float(control), device=texts.device)
+            for control in (p_control, e_control, d_control)
+        ]
+        if conditioning is None:
+            conditioning = model.get_conditioning(speakers, ages, age_vectors)
+        if conditioning is None:
+            conditioning = torch.zeros(
+                batch_size, model.encoder.d_model, device=texts.device
+            )
+
+        # Stage A: encoder and duration prediction
+        def encode(conditioning, texts, src_lens, d_control):
+            return self.encode(conditioning, texts, src_lens, d_control)
+
+        texts = F.pad(texts[:, :max_src_len], (0, text_bucket - max_src_len))
+        output, src_masks, d_rounded = self.run(
+            self.encoders,
+            (batch_size, text_bucket),
+            encode,
+            (conditioning, texts, src_lens, d_control),
+        )
+
+        max_mel_len = int(torch.clamp(d_rounded, min=0).long().sum(dim=1).max())
+        mel_bucket = next((b for b in self.mel_buckets if b >= max_mel_len), None)
+        if mel_bucket is None:
+            outputs = model.decode(
+                output,
+                src_masks,
+                src_lens,
+                d_targets=d_rounded,
+                p_control=p_control,
+                e_control=e_control,
+            )
+            mel_bucket = max_mel_len
+        else:
+            # Stage B: variance adaptor with the predicted durations, decoder and postnet
+            def decode(output, src_masks, src_lens, d_rounded, p_control, e_control):
+                return model.decode(
+                    output,
+                    src_masks,
+                    src_lens,
+                    max_mel_len=mel_bucket,
+                    d_targets=d_rounded,
+                    p_control=p_control,
+                    e_control=e_control,
+                )
+
+            outputs = self.run(
+                self.decoders,
+                (batch_size, text_bucket, mel_bucket),
+                decode,
+                (output, src_masks, src_lens, d_rounded, p_control, e_control),
+            )
+
+        # Trim the padding of the buckets
+        pitch_level = model.variance_adaptor.pitch_feature_level
+        energy_level = model.variance_adaptor.energy_feature_level
+        text_outputs = [4, 5, 6]
+        text_outputs += [2] if pitch_level == "phoneme_level" else []
+        text_outputs += [3] if energy_level == "phoneme_level" else []
+        return tuple(
+            out
+            if i in [8, 9]
+            else out[:, :max_src_len]
+            if i in text_outputs
+            else out[:, :max_mel_len]
+            for i, out in enumerate(outputs)
+        )
@@ -31,6 +31,7 @@ def get_model(args, configs, device, train=False):
 
     model.eval()
     model.requires_grad_ = False
+    model.postnet.fuse_batchnorm()
     return model
 
 
@@ -0,0 +1,96 @@
+import time
+import queue
+import threading
+from collections import OrderedDict
+
+
+class PendingRequest:
+    def __init__(self, request, length, key):
+        self.request = request
+        self.length = length
+        self.key = key
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatchScheduler:
+    """ Online micro-batching of single-utterance requests.
+
+    Requests submitted concurrently are collected for at most max_wait seconds,
+    grouped by key (e.g. the control values) and by phoneme length bucket, and
+    handed to process_batch as lists of at most max_batch_size requests.
+    process_batch must return one result per request, in the same order.
+    """
+
+    def __init__(self, process_batch, max_batch_size=8, max_wait=0.01, bucket_size=32):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.bucket_size = bucket_size
+
+        self.queue = queue.Queue()
+        self.n_batches = 0
+        self.n_requests = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, request, length, key=None):
+        """ Block until the request has been processed and return its result """
+        pending = PendingRequest(request, length, key)
+        self.queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def collect(self, first):
+        pending = [first]
+        deadline = time.time() + self.max_wait
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                # Process what has been collected, then stop
+                self.queue.put(None)
+                break
+            pending.append(item)
+        return pending
+
+    def group(self, pending):
+        groups = OrderedDict()
+        for item in pending:
+            groups.setdefault((item.key, item.length // self.bucket_size), []).append(item)
+
+        batches = []
+        for group in groups.values():
+            for i in range(0, len(group), self.max_batch_size):
+                batches.append(group[i : i + self.max_batch_size])
+        return batches
+
+    def run(self):
+        while True:
+            first = self.queue.get()
+            if first is None:
+                break
+            for batch in self.group(self.collect(first)):
+                try:
+                    results = self.process_batch([item.request for item in batch])
+                    for item, result in zip(batch, results):
+                        item.result = result
+                except Exception as e:
+                    for item in batch:
+                        item.error = e
+                self.n_batches += 1
+                self.n_requests += len(batch)
+                for item in batch:
+                    item.done.set()
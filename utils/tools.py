@@ -1,5 +1,7 @@
 import os
 import json
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import torch
 import torch.nn.functional as F
@@ -12,7 +14,7 @@ from matplotlib import pyplot as plt
 matplotlib.use("Agg")
 
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+_positions = {}
 
 
 def to_device(data, device):
@@ -92,13 +94,27 @@ def log(
         )
 
 
+def get_positions(max_len, device):
+    """ arange(max_len) on device, sliced from a buffer cached per device that grows geometrically """
+    if torch.jit.is_tracing():
+        # Kept in the graph so that traced models have dynamic lengths
+        return torch.arange(max_len, device=device)
+
+    max_len = int(max_len)
+    positions = _positions.get(device)
+    if positions is None or positions.size(0) < max_len:
+        size = max_len if positions is None else max(max_len, 2 * positions.size(0))
+        positions = torch.arange(size, device=device)
+        _positions[device] = positions
+    return positions[:max_len]
+
+
 def get_mask_from_lengths(lengths, max_len=None):
-    batch_size = lengths.shape[0]
     if max_len is None:
-        max_len = torch.max(lengths).item()
+        max_len = torch.max(lengths)
 
-    ids = torch.arange(0, max_len).unsqueeze(0).expand(batch_size, -1).to(device)
-    mask = ids >= lengths.unsqueeze(1).expand(-1, max_len)
+    ids = get_positions(max_len, lengths.device)
+    mask = ids.unsqueeze(0) >= lengths.unsqueeze(1)
 
     return mask
 
@@ -110,6 +126,56 @@ def expand(values, durations):
     return np.array(out)
 
 
+@lru_cache(maxsize=None)
+def read_stats(preprocessed_path):
+    with open(os.path.join(preprocessed_path, "stats.json")) as f:
+        stats = json.load(f)
+        stats = stats["pitch"] + stats["energy"][:2]
+    return stats
+
+
+def get_stats(preprocess_config):
+    """ Pitch and energy statistics used for plotting, read once per preprocessed dataset """
+    return read_stats(preprocess_config["path"]["preprocessed_path"])
+
+
+def save_mel_plot(data, stats, titles, filename):
+    fig = plot_mel(data, stats, titles)
+    fig.savefig(filename)
+    plt.close(fig)
+
+
+class MelPlotter:
+    """ Saves the spectrogram figures of synthesized samples as png files.
+    With n_workers > 0 the figures are drawn in background processes, so that
+    matplotlib does not slow down the synthesis loop """
+
+    def __init__(self, preprocess_config, path, n_workers=1):
+        self.stats = get_stats(preprocess_config)
+        self.path = path
+        self.executor = ProcessPoolExecutor(n_workers) if n_workers > 0 else None
+        self.futures = []
+
+    def plot(self, basename, mel, pitch, energy):
+        args = (
+            [(mel, pitch, energy)],
+            self.stats,
+            ["Synthetized Spectrogram"],
+            os.path.join(self.path, "{}.png".format(basename)),
+        )
+        if self.executor is None:
+            save_mel_plot(*args)
+        else:
+            self.futures.append(self.executor.submit(save_mel_plot, *args))
+
+    def close(self):
+        if self.executor is not None:
+            for future in self.futures:
+                future.result()
+            self.executor.shutdown()
+        self.futures = []
+
+
 def synth_one_sample(targets, predictions, vocoder, model_config, preprocess_config):
 
     basename = targets[0][0]
@@ -129,11 +195,7 @@ def synth_one_sample(targets, predictions, vocoder, model_config, preprocess_con
     else:
         energy = targets[11][0, :mel_len].detach().cpu().numpy()
 
-    with open(
-        os.path.join(preprocess_config["path"]["preprocessed_path"], "stats.json")
-    ) as f:
-        stats = json.load(f)
-        stats = stats["pitch"] + stats["energy"][:2]
+    stats = get_stats(preprocess_config)
 
     fig = plot_mel(
         [
@@ -165,53 +227,138 @@ def synth_one_sample(targets, predictions, vocoder, model_config, preprocess_con
     return fig, wav_reconstruction, wav_prediction, basename
 
 
-def synth_samples(targets, predictions, vocoder, model_config, preprocess_config, path):
+def synth_samples(
+    targets,
+    predictions,
+    vocoder,
+    model_config,
+    preprocess_config,
+    path,
+    plotter=None,
+    writer=None,
+    vocoder_cache=None,
+):
+    """ Vocode a batch of predictions and return the waveforms.
+    If path is None, nothing is written to disk (e.g. when serving requests).
+    Spectrogram figures are only drawn when a MelPlotter is given, and the
+    waveforms are handed to the WavWriter, if any, instead of being written here.
+    With a VocoderCache, mels that were already vocoded are not vocoded again """
 
     basenames = targets[0]
-    for i in range(len(predictions[0])):
-        basename = basenames[i]
-        src_len = predictions[8][i].item()
-        mel_len = predictions[9][i].item()
-        mel_prediction = predictions[1][i, :mel_len].detach().transpose(0, 1)
-        duration = predictions[5][i, :src_len].detach().cpu().numpy()
-        if preprocess_config["preprocessing"]["pitch"]["feature"] == "phoneme_level":
-            pitch = predictions[2][i, :src_len].detach().cpu().numpy()
-            pitch = expand(pitch, duration)
-        else:
-            pitch = predictions[2][i, :mel_len].detach().cpu().numpy()
-        if preprocess_config["preprocessing"]["energy"]["feature"] == "phoneme_level":
-            energy = predictions[3][i, :src_len].detach().cpu().numpy()
-            energy = expand(energy, duration)
-        else:
-            energy = predictions[3][i, :mel_len].detach().cpu().numpy()
-
-        with open(
-            os.path.join(preprocess_config["path"]["preprocessed_path"], "stats.json")
-        ) as f:
-            stats = json.load(f)
-            stats = stats["pitch"] + stats["energy"][:2]
-
-        fig = plot_mel(
-            [
-                (mel_prediction.cpu().numpy(), pitch, energy),
-            ],
-            stats,
-            ["Synthetized Spectrogram"],
-        )
-        plt.savefig(os.path.join(path, "{}.png".format(basename)))
-        plt.close()
+    if plotter is not None:
+        for i in range(len(predictions[0])):
+            basename = basenames[i]
+            src_len = predictions[8][i].item()
+            mel_len = predictions[9][i].item()
+            mel_prediction = predictions[1][i, :mel_len].detach().transpose(0, 1)
+            duration = predictions[5][i, :src_len].detach().cpu().numpy()
+            if preprocess_config["preprocessing"]["pitch"]["feature"] == "phoneme_level":
+                pitch = predictions[2][i, :src_len].detach().cpu().numpy()
+                pitch = expand(pitch, duration)
+            else:
+                pitch = predictions[2][i, :mel_len].detach().cpu().numpy()
+            if preprocess_config["preprocessing"]["energy"]["feature"] == "phoneme_level":
+                energy = predictions[3][i, :src_len].detach().cpu().numpy()
+                energy = expand(energy, duration)
+            else:
+                energy = predictions[3][i, :mel_len].detach().cpu().numpy()
+
+            plotter.plot(basename, mel_prediction.cpu().numpy(), pitch, energy)
 
     from .model import vocoder_infer
 
     mel_predictions = predictions[1].transpose(1, 2)
-    lengths = predictions[9] * preprocess_config["preprocessing"]["stft"]["hop_length"]
     wav_predictions = vocoder_infer(
-        mel_predictions, vocoder, model_config, preprocess_config, lengths=lengths
+        mel_predictions,
+        vocoder,
+        model_config,
+        preprocess_config,
+        mel_lens=predictions[9].tolist(),
+        cache=vocoder_cache,
     )
 
-    sampling_rate = preprocess_config["preprocessing"]["audio"]["sampling_rate"]
-    for wav, basename in zip(wav_predictions, basenames):
-        wavfile.write(os.path.join(path, "{}.wav".format(basename)), sampling_rate, wav)
+    if path is not None and writer is not None:
+        for wav, basename in zip(wav_predictions, basenames):
+            writer.write(basename, wav)
+    elif path is not None:
+        sampling_rate = preprocess_config["preprocessing"]["audio"]["sampling_rate"]
+        for wav, basename in zip(wav_predictions, basenames):
+            wavfile.write(os.path.join(path, "{}.wav".format(basename)), sampling_rate, wav)
+
+    return wav_predictions
+
+
+class WavWriter:
+    """ Writes synthesized int16 waveforms in background threads, so that the
+    next batch can already run through the model.
+
+    output_format is one of:
+        - "wav": one wav file per utterance
+        - "flac": one flac file per utterance
+        - "pcm": raw 16-bit PCM shards of shard_size utterances, each with a
+          text index of "basename|offset|n_samples" lines (in samples)
+    """
+
+    def __init__(self, path, sampling_rate, output_format="wav", n_workers=2, shard_size=1000):
+        assert output_format in ["wav", "flac", "pcm"]
+        self.path = path
+        self.sampling_rate = sampling_rate
+        self.output_format = output_format
+        self.shard_size = shard_size
+
+        # Shards are appended to, so they are written by a single thread
+        if output_format == "pcm":
+            n_workers = 1
+        self.executor = ThreadPoolExecutor(n_workers)
+        self.futures = []
+
+        self.n_written = 0
+        self.shard = None
+        self.shard_index = None
+        self.shard_offset = 0
+
+    def write(self, basename, wav):
+        self.futures.append(self.executor.submit(self._write, basename, wav))
+
+    def _write(self, basename, wav):
+        if self.output_format == "wav":
+            wavfile.write(
+                os.path.join(self.path, "{}.wav".format(basename)), self.sampling_rate, wav
+            )
+        elif self.output_format == "flac":
+            import soundfile
+
+            soundfile.write(
+                os.path.join(self.path, "{}.flac".format(basename)),
+                wav,
+                self.sampling_rate,
+                format="FLAC",
+                subtype="PCM_16",
+            )
+        else:
+            if self.n_written % self.shard_size == 0:
+                self._close_shard()
+                name = "shard_{:05d}".format(self.n_written // self.shard_size)
+                self.shard = open(os.path.join(self.path, name + ".pcm"), "wb")
+                self.shard_index = open(os.path.join(self.path, name + ".txt"), "w")
+                self.shard_offset = 0
+            self.shard.write(wav.astype("<i2").tobytes())
+            self.shard_index.write("{}|{}|{}\n".format(basename, self.shard_offset, len(wav)))
+            self.shard_offset += len(wav)
+        self.n_written += 1
+
+    def _close_shard(self):
+        if self.shard is not None:
+            self.shard.close()
+            self.shard_index.close()
+            self.shard = self.shard_index = None
+
+    def close(self):
+        for future in self.futures:
+            future.result()
+        self.futures = []
+        self.executor.shutdown()
+        self._close_shard()
 
 
 def plot_mel(data, stats, titles):